@@ -0,0 +1,105 @@
+# Content-hashed store for cover art.
+# Embedded pictures are read natively through FlacMeta, and every unique picture is written to the store once, named after the SHA-1 of its data. Tracks that share artwork (every track of an album, singles with the same cover) share one file.
+# Every stored picture is turned into a FLAC PICTURE block once, and written into outputs natively (FlacMeta.writeFlac) together with their tags.
+# Optionally, artwork larger than a maximum size is scaled down and recompressed as JPEG, once per unique picture (needs Pillow).
+
+from hashlib import sha1
+from io import BytesIO
+from pathlib import Path
+from threading import Lock, get_ident
+import os
+
+from FlacMeta import readFlac, parsePicture, makePicture
+
+# JPEG quality of resized artwork.
+RESIZE_QUALITY = 90
+
+# Safe to share between worker threads.
+class ArtworkStore:
+    def __init__(self, store_dir: Path, max_size=None):
+        self.store_dir = Path(store_dir)
+        self.max_size = max_size
+        if max_size is not None:
+            # Pillow is only needed for resizing, which imports it where it is used. Fail now if it is missing, rather than on the first picture.
+            import PIL.Image
+        self.lock = Lock()
+        # Source (resolved path, size, mtime) -> stored picture, or None if the source has no picture.
+        self.sources = {}
+        # SHA-1 of the original picture data -> stored picture.
+        self.pictures = {}
+        # Stored picture -> PICTURE block body.
+        self.blocks = {}
+
+    # Returns the stored copy of the first picture embedded in a FLAC file, or None if it has none. info is the file's probe result, if there is one at hand, so the picture is found without parsing the metadata again.
+    def extract(self, flac_path: Path, info=None):
+        stat = os.stat(flac_path)
+        key = (str(Path(flac_path).resolve()), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.sources:
+                return self.sources[key]
+        if info is None:
+            info = readFlac(flac_path)
+        picture = None
+        if info["pictures"]:
+            header = info["pictures"][0]
+            with open(flac_path, "rb") as f:
+                f.seek(header["offset"])
+                data = parsePicture(f.read(header["length"]), with_data=True)["data"]
+            picture = self.store(data, ".png" if header["mime"] == "image/png" else ".jpg")
+        with self.lock:
+            self.sources[key] = picture
+        return picture
+
+    # Returns the stored copy of a picture file (such as a cover.jpg next to the tracks). Without resizing, the file is used as it is.
+    def add(self, path: Path):
+        if self.max_size is None:
+            return Path(path)
+        with open(path, "rb") as f:
+            return self.store(f.read(), Path(path).suffix.lower())
+
+    # Writes picture data to the store, unless the same data is already there, and returns its path.
+    def store(self, data, suffix):
+        digest = sha1(data).hexdigest()
+        with self.lock:
+            picture = self.pictures.get(digest)
+        if picture is not None:
+            return picture
+        if self.max_size is not None:
+            data, suffix = self.shrink(data, suffix)
+        picture = self.store_dir / f"{digest}{suffix}"
+        if not picture.is_file():
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            # Written under a unique name and renamed, so another thread storing the same picture never sees half a file.
+            temp_file = picture.with_name(f"{picture.name}.{os.getpid()}.{get_ident()}.tmp")
+            with open(temp_file, "wb") as f:
+                f.write(data)
+            os.replace(temp_file, picture)
+        with self.lock:
+            self.pictures[digest] = picture
+        return picture
+
+    # Scales a picture down to max_size on its longest side and recompresses it as JPEG, if it is bigger than that. Returns (data, suffix).
+    def shrink(self, data, suffix):
+        from PIL import Image
+        try:
+            image = Image.open(BytesIO(data))
+        except OSError:
+            # Not something Pillow can read; embed it as it is.
+            return data, suffix
+        if max(image.size) <= self.max_size:
+            return data, suffix
+        image.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+        output = BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=RESIZE_QUALITY, optimize=True)
+        return output.getvalue(), ".jpg"
+
+    # Returns the PICTURE block body (as the front cover) for a stored picture, for FlacMeta.writeFlac. Built once per picture.
+    def block(self, picture: Path):
+        with self.lock:
+            body = self.blocks.get(picture)
+        if body is None:
+            with open(picture, "rb") as f:
+                body = makePicture(f.read())
+            with self.lock:
+                self.blocks[picture] = body
+        return body
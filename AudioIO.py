@@ -0,0 +1,255 @@
+# Chunked audio I/O for NumPy.
+# WAV files are memory-mapped and handed out a block at a time as zero-copy NumPy views of the mapping. Once a block is done with, its pages are given back to the OS,
+# so memory use stays flat however long the file is, and however many files are open at once. Known-length WAV files are written the same way, straight into a mapping.
+# Streams (the raw frames a decoder writes to a pipe, which cannot be mapped) are read into one buffer that is reused for every block, so reading a block allocates nothing either.
+# Sample formats: 16, 24 and 32-bit integer PCM, and 32 and 64-bit float. 24-bit samples have no NumPy type, so their views are frames x channels x 3 bytes.
+
+from pathlib import Path
+import mmap
+import struct
+import numpy as np
+
+# Frames per block.
+BLOCK_FRAMES = 1 << 16
+# Sample types of the formats that have one, by (bits, is_float).
+SAMPLE_TYPES = {(16, False): "<i2", (32, False): "<i4", (32, True): "<f4", (64, True): "<f8"}
+
+# Returns (channels, rate, bits, is_float) from the body of a fmt chunk.
+def parseFormat(body):
+    format_tag, channels, rate, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+    if format_tag == 0xFFFE:
+        # WAVE_FORMAT_EXTENSIBLE: the real format is at the start of the sub-format GUID.
+        format_tag = struct.unpack("<H", body[24:26])[0]
+    return channels, rate, bits, format_tag == 3
+
+# Reads a WAV header from a stream that cannot seek. Returns (header bytes, channels, rate, bits, is_float, data size). Data size is None if the writer left it unknown.
+def readWavHeader(stream):
+    header = bytearray(stream.read(12))
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("Not a WAV stream.")
+    channels = rate = bits = None
+    is_float = False
+    while True:
+        chunk_header = stream.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError("WAV stream has no data chunk.")
+        header += chunk_header
+        chunk_id, size = chunk_header[:4], struct.unpack("<I", chunk_header[4:])[0]
+        if chunk_id == b"data":
+            return bytes(header), channels, rate, bits, is_float, None if size in (0, 0xFFFFFFFF) else size
+        body = stream.read(size + size % 2)
+        header += body
+        if chunk_id == b"fmt ":
+            channels, rate, bits, is_float = parseFormat(body)
+
+# Returns a canonical 44-byte WAV header. If frames is None, the sizes are left at their maximum, as ffmpeg does when writing to a pipe.
+def wavHeader(rate, channels, bits, frames=None):
+    block_align = channels * bits // 8
+    data_size = 0xFFFFFFFF if frames is None else frames * block_align
+    riff_size = 0xFFFFFFFF if frames is None else 36 + data_size
+    return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * block_align, block_align, bits)
+            + b"data" + struct.pack("<I", data_size))
+
+# Returns a zero-copy view of little-endian PCM in buffer (bytes, a memoryview or a mapping): frames x channels, or frames x channels x 3 bytes for 24-bit.
+def pcmView(buffer, channels, bits, is_float=False):
+    if bits == 24 and not is_float:
+        return np.frombuffer(buffer, np.uint8).reshape(-1, channels, 3)
+    if (bits, is_float) not in SAMPLE_TYPES:
+        raise ValueError(f"Unsupported sample format: {bits}-bit {'float' if is_float else 'PCM'}.")
+    return np.frombuffer(buffer, SAMPLE_TYPES[bits, is_float]).reshape(-1, channels)
+
+# Converts a PCM view (see pcmView) to float samples (frames x channels, full scale 1.0).
+def toFloat(samples, bits, is_float=False):
+    if is_float:
+        return samples.astype(np.float64)
+    if bits == 24:
+        ints = np.zeros(samples.shape[:2] + (4,), np.uint8)
+        ints[..., 1:] = samples
+        return ints.view("<i4")[..., 0] / 2147483648.0
+    return samples / float(1 << (bits - 1))
+
+# Converts little-endian PCM bytes to float samples (frames x channels).
+def fromPCM(data, channels, bits, is_float):
+    return toFloat(pcmView(data, channels, bits, is_float), bits, is_float)
+
+# Quantizes float samples to integer PCM of the given bit depth, laid out as pcmView lays it out.
+def quantize(samples, bits):
+    scale = float(1 << (bits - 1))
+    ints = np.clip(np.rint(samples * scale), -scale, scale - 1).astype("<i4")
+    if bits == 16:
+        return ints.astype("<i2")
+    if bits == 24:
+        return ints.view(np.uint8).reshape(ints.shape + (4,))[..., :3]
+    return ints
+
+# Converts float samples to little-endian PCM bytes of the given bit depth.
+def toPCM(samples, bits):
+    return quantize(samples, bits).tobytes()
+
+# Gives the pages of mapping between start and stop back to the OS. The data stays in the file (and the page cache); it is only dropped from this process.
+def release(mapping, start, stop):
+    if not hasattr(mapping, "madvise"):
+        # Not available on Windows, which trims mapped pages by itself.
+        return start
+    stop -= stop % mmap.PAGESIZE
+    start -= start % mmap.PAGESIZE
+    if stop > start:
+        mapping.madvise(mmap.MADV_DONTNEED, start, stop - start)
+    return max(start, stop)
+
+# Closes a mapping, unless views of it are still alive, in which case it is closed when the last of them goes.
+def closeMapping(mapping):
+    try:
+        mapping.close()
+    except BufferError:
+        pass
+
+# A WAV file, read through a memory mapping. Use as a context manager, or call close().
+class WavReader:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(self.path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.file.close()
+            raise
+        if hasattr(self.map, "madvise"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            self.parseHeader()
+        except BaseException:
+            self.close()
+            raise
+
+    def parseHeader(self):
+        data = self.map
+        if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+            raise ValueError(f"{self.path} is not a WAV file.")
+        self.channels = self.rate = self.bits = None
+        self.is_float = False
+        position = 12
+        while position + 8 <= len(data):
+            chunk_id, size = data[position:position + 4], struct.unpack("<I", data[position + 4:position + 8])[0]
+            position += 8
+            if chunk_id == b"fmt ":
+                self.channels, self.rate, self.bits, self.is_float = parseFormat(data[position:position + size])
+            elif chunk_id == b"data":
+                if self.channels is None:
+                    raise ValueError(f"{self.path} has no fmt chunk before its data.")
+                # Writers that could not seek back leave the size unknown; the samples then run to the end of the file.
+                if size in (0, 0xFFFFFFFF) or position + size > len(data):
+                    size = len(data) - position
+                self.frame_size = self.channels * self.bits // 8
+                self.offset = position
+                self.frames = size // self.frame_size
+                return
+            position += size + size % 2
+        raise ValueError(f"{self.path} has no data chunk.")
+
+    # Returns a zero-copy view of frames [start, stop) (see pcmView).
+    def view(self, start, stop):
+        stop = min(stop, self.frames)
+        begin = self.offset + start * self.frame_size
+        return pcmView(memoryview(self.map)[begin:self.offset + stop * self.frame_size], self.channels, self.bits, self.is_float)
+
+    # Yields zero-copy views of successive blocks of frames. A block's pages are given back once the next block is asked for, so do not keep blocks around.
+    def blocks(self, frames=BLOCK_FRAMES):
+        released = 0
+        for start in range(0, self.frames, frames):
+            yield self.view(start, start + frames)
+            released = release(self.map, released, self.offset + min(start + frames, self.frames) * self.frame_size)
+
+    # Converts a view of this file to float samples.
+    def toFloat(self, samples):
+        return toFloat(samples, self.bits, self.is_float)
+
+    def close(self):
+        closeMapping(self.map)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# A WAV file of integer PCM with a known number of frames, written through a memory mapping. Frames that are never written are silence. Use as a context manager, or call close().
+class WavWriter:
+    def __init__(self, path, rate, channels, bits, frames):
+        self.path = Path(path)
+        self.channels = channels
+        self.bits = bits
+        self.frames = frames
+        self.frame_size = channels * bits // 8
+        header = wavHeader(rate, channels, bits, frames)
+        self.offset = len(header)
+        self.position = 0
+        self.released = 0
+        self.file = open(self.path, "w+b")
+        try:
+            self.file.write(header)
+            # The samples start out as a hole in the file, which reads as silence.
+            self.file.truncate(self.offset + frames * self.frame_size)
+            self.map = mmap.mmap(self.file.fileno(), 0) if frames else None
+        except BaseException:
+            self.file.close()
+            raise
+
+    # Quantizes float samples (frames x channels) into the next frames of the file. Samples past the promised length are dropped.
+    def write(self, samples):
+        count = min(len(samples), self.frames - self.position)
+        if count <= 0:
+            return
+        begin = self.offset + self.position * self.frame_size
+        self.position += count
+        end = self.offset + self.position * self.frame_size
+        view = pcmView(memoryview(self.map)[begin:end], self.channels, self.bits)
+        view[:] = quantize(samples[:count], self.bits)
+        del view
+        self.released = release(self.map, self.released, end)
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            closeMapping(self.map)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Reads a stream of raw frames (a decoder's output, say) in blocks, into one buffer that is reused for every block. Yields a memoryview of whole frames per block, valid until the next block is read.
+# limit, if given, is the number of bytes to read. A truncated last frame is not yielded, but is left in tail once the stream ends.
+class StreamReader:
+    def __init__(self, stream, frame_size, frames=BLOCK_FRAMES, limit=None):
+        self.stream = stream
+        self.frame_size = frame_size
+        self.buffer = memoryview(bytearray(frames * frame_size))
+        self.limit = limit
+        self.tail = b""
+
+    def __iter__(self):
+        remaining = self.limit
+        carry = 0
+        while True:
+            size = carry
+            end = len(self.buffer) if remaining is None else min(len(self.buffer), carry + remaining)
+            while size < end:
+                count = self.stream.readinto(self.buffer[size:end])
+                if not count:
+                    break
+                size += count
+            if remaining is not None:
+                remaining -= size - carry
+            whole = size - size % self.frame_size
+            if whole == 0:
+                self.tail = bytes(self.buffer[:size])
+                return
+            yield self.buffer[:whole]
+            # Move a partial frame to the front, to be completed by the next read.
+            carry = size - whole
+            self.buffer[:carry] = self.buffer[whole:size]
@@ -0,0 +1,244 @@
+# Reproducible benchmark for Normalize.py.
+# Generates a synthetic library (albums, multidisc albums, artist directories with singles, lone singles; 44.1/48/96/192 kHz, 16/24-bit, with cover art) with ffmpeg, once, and converts it with lightweight stand-ins for FLACCL, LossyWAV, ReSampler and metaflac.
+# The stand-ins only copy their input to their output, so what is measured is process spawning, decoding, piping and orchestration: everything except the encoders themselves.
+# Reports files/sec and peak RSS (of the largest process in the run) for every scenario, and compares them against a stored baseline.
+# The stand-ins are scripts, so this runs on *nix (or WSL), not on plain Windows.
+# Usage: python Benchmark.py [--scale N] [--seconds S] [--jobs N] [--repeat N] [--scenarios a,b,...] [--baseline <file>] [--save-baseline] [--tolerance <percent>]
+
+from pathlib import Path
+from subprocess import Popen, check_call, DEVNULL
+from tempfile import gettempdir, mkdtemp
+from time import perf_counter
+import argparse
+import json
+import os
+import shutil
+import sys
+
+CORPUS_VERSION = 1
+BASELINE_VERSION = 1
+# Source formats, cycled through album by album (and single by single): (sample rate, bits per sample).
+FORMATS = ((44100, 16), (48000, 24), (96000, 24), (192000, 24))
+
+# One script serves as every stand-in; it acts according to the name it was started under.
+STUB = r'''#!{python}
+import os, shutil, sys
+name = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+def source(path):
+    return sys.stdin.buffer if path == "-" else open(path, "rb")
+if name == "CUETools.FLACCL.cmd.exe":
+    # -o <output> [options] <input or ->
+    with source(args[-1]) as f, open(args[args.index("-o") + 1], "wb") as out:
+        head = f.read(4)
+        if head != b"fLaC":
+            # WAV in: a FLAC header (STREAMINFO only, as the last metadata block) in front of it, so the output takes tags like an encoder's would.
+            out.write(b"fLaC\x80\x00\x00\x22" + bytes(10) + (44100 << 44 | 1 << 41 | 15 << 36).to_bytes(8, "big") + bytes(16))
+        out.write(head)
+        shutil.copyfileobj(f, out, 1 << 20)
+elif name == "CUETools.LossyWAV.exe":
+    # <input or -> -<quality> --stdout
+    with source(args[0]) as f:
+        shutil.copyfileobj(f, sys.stdout.buffer, 1 << 20)
+elif name == "ReSampler":
+    # -i <input> -o <output> [options]
+    shutil.copyfile(args[args.index("-i") + 1], args[args.index("-o") + 1])
+elif name == "metaflac":
+    # Tags and pictures are not written; only the launch and reading the input are.
+    if any(arg.endswith("=-") and arg.startswith("--import") for arg in args):
+        sys.stdin.buffer.read()
+'''
+
+# Scenarios: extra Normalize.py arguments. {resampler} is replaced with the ReSampler stand-in.
+SCENARIOS = {
+    "lossless": ["--mode", "lossless", "--resample-mode", "original"],
+    "lossy": ["--mode", "S", "--resample-mode", "original"],
+    "resample-soxr": ["--mode", "lossless", "--resample-mode", "base", "--resampler-backend", "soxr"],
+    "resample-resampler": ["--mode", "lossless", "--resample-mode", "base", "--resampler-backend", "resampler", "--resampler", "{resampler}"],
+    "resample-numpy": ["--mode", "lossless", "--resample-mode", "base", "--resampler-backend", "numpy"],
+    "replaygain": ["--mode", "lossless", "--resample-mode", "original", "--replaygain"],
+    "passthrough": ["--mode", "lossless", "--resample-mode", "original", "--passthrough", "link"],
+    # Converts the library, then measures a second run over the finished output, where every track is skipped.
+    "rerun": ["--mode", "lossless", "--resample-mode", "original"],
+}
+
+# Writes a stand-in under each name it answers to, into stub_dir. Returns stub_dir.
+def writeStubs(stub_dir: Path):
+    (stub_dir / "cue").mkdir(parents=True, exist_ok=True)
+    for path in (stub_dir / "cue" / "CUETools.FLACCL.cmd.exe", stub_dir / "cue" / "CUETools.LossyWAV.exe", stub_dir / "ReSampler", stub_dir / "metaflac"):
+        path.write_text(STUB.replace("{python}", sys.executable))
+        path.chmod(0o755)
+    return stub_dir
+
+# Returns the layout of the synthetic library: a list of (relative path, album, sample rate, bits per sample) for every FLAC file, and a list of relative paths of other files.
+def libraryLayout(scale):
+    flacs, others = [], []
+    count = 0
+    def nextFormat():
+        nonlocal count
+        count += 1
+        return FORMATS[(count - 1) % len(FORMATS)]
+    for artist in range(scale):
+        root = f"Artist {artist:02}"
+        # Singles next to the artist's albums (DirIsAnAlbum == 0).
+        for single in range(3):
+            flacs.append((f"{root}/{single + 1:02} Single {single}.flac", f"Single {artist}-{single}", *nextFormat()))
+        # An album with its cover and rip log (DirIsAnAlbum == 1).
+        rate, bits = nextFormat()
+        for track in range(8):
+            flacs.append((f"{root}/Album/{track + 1:02} Track.flac", f"Album {artist}", rate, bits))
+        others += [f"{root}/Album/cover.jpg", f"{root}/Album/rip.log"]
+        # A multidisc album: no FLAC files at its root (DirIsAnAlbum == -2), one album per disc.
+        others.append(f"{root}/Multidisc/cover.jpg")
+        for disc in range(2):
+            rate, bits = nextFormat()
+            for track in range(5):
+                flacs.append((f"{root}/Multidisc/CD{disc + 1}/{track + 1:02} Track.flac", f"Multidisc {artist}", rate, bits))
+        # A directory with a single track (DirIsAnAlbum == -1).
+        flacs.append((f"{root}/Lone/01 Lone.flac", f"Lone {artist}", *nextFormat()))
+    return flacs, others
+
+# Generates the synthetic library under corpus_dir, unless the same library is already there. Audio is seeded pink noise, so the corpus is the same on every run.
+def makeCorpus(corpus_dir: Path, scale, seconds, ffmpeg_path):
+    spec = {"version": CORPUS_VERSION, "scale": scale, "seconds": seconds}
+    spec_file = corpus_dir / "corpus.json"
+    library = corpus_dir / "library"
+    flacs, others = libraryLayout(scale)
+    if spec_file.is_file() and json.loads(spec_file.read_text()) == spec:
+        return library, len(flacs)
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    library.mkdir(parents=True)
+    cover = corpus_dir / "cover.jpg"
+    check_call([ffmpeg_path, "-v", "error", "-f", "lavfi", "-i", "color=c=0x336699:s=1000x1000:d=1", "-frames:v", "1", str(cover)])
+    print(f"Generating {len(flacs)} tracks in {library}...")
+    for seed, (relative, album, rate, bits) in enumerate(flacs):
+        path = library / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        check_call([ffmpeg_path, "-v", "error", "-f", "lavfi", "-i", f"anoisesrc=color=pink:seed={seed}:amplitude=0.25:sample_rate={rate}:duration={seconds}",
+                    "-i", str(cover), "-map", "0:a", "-map", "1:v", "-ac", "2",
+                    "-c:a", "flac", "-compression_level", "0", "-sample_fmt", "s16" if bits == 16 else "s32", "-bits_per_raw_sample", str(bits),
+                    "-c:v", "copy", "-disposition:v", "attached_pic", "-metadata:s:v", "comment=Cover (front)",
+                    "-metadata", f"ALBUM={album}", "-metadata", f"TITLE={path.stem}", "-metadata", "ARTIST=Benchmark", str(path)])
+    for relative in others:
+        path = library / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".jpg":
+            shutil.copyfile(cover, path)
+        else:
+            path.write_text("Synthetic rip log.\n")
+    spec_file.write_text(json.dumps(spec))
+    return library, len(flacs)
+
+# Runs a command and waits for it. Returns (wall time, peak RSS in MB of the largest process in its tree, or None where the OS does not report it).
+def runMeasured(command, env, log_file):
+    with open(log_file, "wb") as log:
+        start = perf_counter()
+        process = Popen(command, env=env, stdout=log, stderr=log, stdin=DEVNULL)
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = perf_counter() - start
+            # ru_maxrss is in KB on Linux, in bytes on macOS.
+            peak = usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        else:
+            process.wait()
+            elapsed = perf_counter() - start
+            peak = None
+    if process.returncode != 0:
+        raise RuntimeError(f"{command[1]} exited with status {process.returncode}. Its output is in {log_file}.")
+    return elapsed, peak
+
+# Runs one scenario repeat times over a fresh output directory. Returns {"seconds", "files_per_sec", "peak_rss_mb"}, from the fastest repeat (and the highest peak).
+def runScenario(name, library, files, stubs, work_dir, args):
+    normalize = Path(__file__).resolve().parent / "Normalize.py"
+    extra = [arg.replace("{resampler}", str(stubs / "ReSampler")) for arg in SCENARIOS[name]]
+    env = dict(os.environ, PATH=str(stubs) + os.pathsep + os.environ.get("PATH", ""))
+    times, peaks = [], []
+    for repeat in range(args.repeat):
+        run_dir = work_dir / f"{name}-{repeat}"
+        shutil.rmtree(run_dir, ignore_errors=True)
+        run_dir.mkdir(parents=True)
+        command = [sys.executable, str(normalize), "-i", str(library), "-o", str(run_dir / "output"),
+                   "--ffmpeg", args.ffmpeg, "--ffprobe", args.ffprobe, "--cue", str(stubs / "cue"), "--metaflac", str(stubs / "metaflac"),
+                   "--jobs", str(args.jobs), "--probe-cache", str(run_dir / "probe_cache.json"), "--timing-log", str(run_dir / "timing.jsonl")] + extra
+        elapsed, peak = runMeasured(command, env, run_dir / "normalize.log")
+        if name == "rerun":
+            elapsed, peak = runMeasured(command, env, run_dir / "normalize-rerun.log")
+        times.append(elapsed)
+        peaks.append(peak)
+        if not args.keep:
+            shutil.rmtree(run_dir / "output", ignore_errors=True)
+    seconds = min(times)
+    return {"seconds": round(seconds, 3), "files_per_sec": round(files / seconds, 3), "peak_rss_mb": None if None in peaks else round(max(peaks), 1)}
+
+# Returns the change from old to new in percent, as text.
+def change(old, new):
+    if not old or new is None:
+        return "-"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks Normalize.py on a synthetic library, with stand-ins for the encoders.")
+    parser.add_argument("--scale", help="Number of artists in the library. Each has 3 singles, an 8-track album, a 2-disc album and a lone single (22 tracks).", type=int, default=2)
+    parser.add_argument("--seconds", help="Length of every track.", type=float, default=10)
+    parser.add_argument("--jobs", help="--jobs for Normalize.py.", type=int, default=4)
+    parser.add_argument("--repeat", help="Runs per scenario. The fastest counts.", type=int, default=3)
+    parser.add_argument("--scenarios", help="Comma-separated scenarios to run. One or more of " + ", ".join(SCENARIOS) + ". Defaults to all.", default=",".join(SCENARIOS))
+    parser.add_argument("--corpus", help="Where the synthetic library is kept between runs.", default=str(Path(gettempdir()) / "musicutils_benchmark"))
+    parser.add_argument("--baseline", help="Baseline file to compare against.", default=str(Path(__file__).resolve().parent / "benchmark_baseline.json"))
+    parser.add_argument("--save-baseline", help="Store the results as the new baseline.", action="store_true")
+    parser.add_argument("--tolerance", help="Slowdown (or RSS growth) in percent against the baseline that counts as a regression.", type=float, default=10)
+    parser.add_argument("--ffmpeg", help="Path to ffmpeg binary.", default="ffmpeg")
+    parser.add_argument("--ffprobe", help="Path to ffprobe binary.", default="ffprobe")
+    parser.add_argument("--keep", help="Keep the converted outputs.", action="store_true")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}")
+        exit(1)
+    corpus_dir = Path(args.corpus) / f"scale{args.scale}-{args.seconds:g}s"
+    library, files = makeCorpus(corpus_dir, args.scale, args.seconds, args.ffmpeg)
+    work_dir = Path(mkdtemp(prefix="musicutils_benchmark_"))
+    stubs = writeStubs(work_dir / "stubs")
+    setup = {"scale": args.scale, "seconds": args.seconds, "jobs": args.jobs}
+    baseline_file = Path(args.baseline)
+    baseline = {}
+    if baseline_file.is_file():
+        saved = json.loads(baseline_file.read_text())
+        if saved.get("version") == BASELINE_VERSION and saved.get("setup") == setup:
+            baseline = saved["results"]
+        else:
+            print(f"{baseline_file} was made with other settings; not comparing.")
+
+    results = {}
+    regressions = []
+    finished = False
+    print(f"{'scenario':<20}{'files/s':>10}{'baseline':>10}{'change':>9}{'peak MB':>10}{'baseline':>10}{'change':>9}")
+    try:
+        for name in scenarios:
+            result = runScenario(name, library, files, stubs, work_dir, args)
+            results[name] = result
+            old = baseline.get(name, {})
+            print(f"{name:<20}{result['files_per_sec']:>10.2f}{old.get('files_per_sec') or 0:>10.2f}{change(old.get('files_per_sec'), result['files_per_sec']):>9}"
+                  f"{result['peak_rss_mb'] or 0:>10.1f}{old.get('peak_rss_mb') or 0:>10.1f}{change(old.get('peak_rss_mb'), result['peak_rss_mb']):>9}", flush=True)
+            if old.get("files_per_sec") and result["files_per_sec"] < old["files_per_sec"] * (1 - args.tolerance / 100):
+                regressions.append(f"{name}: files/s {change(old['files_per_sec'], result['files_per_sec'])}")
+            if old.get("peak_rss_mb") and result["peak_rss_mb"] and result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + args.tolerance / 100):
+                regressions.append(f"{name}: peak RSS {change(old['peak_rss_mb'], result['peak_rss_mb'])}")
+        finished = True
+    finally:
+        if args.keep or not finished:
+            print(f"Outputs and logs are in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.save_baseline:
+        # Scenarios not run this time keep their old baseline.
+        merged = dict(baseline)
+        merged.update(results)
+        baseline_file.write_text(json.dumps({"version": BASELINE_VERSION, "setup": setup, "results": merged}, indent=2))
+        print(f"Saved baseline to {baseline_file}")
+    if regressions:
+        print("Regressions against the baseline: " + "; ".join(regressions))
+        exit(1)
@@ -0,0 +1,683 @@
+# Conversion engine shared by Normalize.py, GPUalbum.py and Music2LossyWav.py, and importable by anything else that converts FLAC files.
+# Nothing happens at import time: no arguments are parsed, no tools are looked for and no directories are made.
+# A Profile says what outputs look like (mode, resampling, cover art, replaygain), Tools says where the binaries are (anything not given is looked for on PATH the first time it is needed),
+# and an Engine converts into one output tree with them: one file at a time with Engine.convert, or a whole tree with Engine.run.
+# convert(source, dest, profile) converts a single file in one call.
+
+from pathlib import Path
+from subprocess import check_output, DEVNULL
+from threading import Lock
+from tempfile import gettempdir, mkdtemp
+from math import ceil
+from time import perf_counter
+import os
+import shutil
+import sys
+
+from Probe import ProbeCache
+from Manifest import Manifest
+from Pipeline import runPipeline, PipelineError
+from Artwork import ArtworkStore
+from Mirror import Mirror, reflink
+from Scheduler import StagedScheduler, Stage
+from FlacMeta import readFlac, writeFlac
+from Scanner import planLibrary, planFiles, entryToJSON
+from Timing import StageTimer, stageName, percentile
+
+def printerr(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+# Sample rates that --resample-mode base picks from.
+BASE_RATES = (44100, 48000)
+# Tracks of one kind (encoder, sample rate and bit depth) that are re-encoded, to learn how well FLACCL compresses them, before any of that kind are passed through.
+PASSTHROUGH_SAMPLES = 3
+# Files mirrored as pictures, which --cover-max-size applies to.
+PICTURE_SUFFIXES = (".jpg", ".jpeg", ".png")
+# Most workers the probe and tag stages of the scheduler grow to. Both mostly wait on the disk.
+PROBE_WORKERS = 4
+TAG_WORKERS = 4
+# Memory estimates for the scheduler's budget: an encode pipeline's processes and pipes, and a resampler (ReSampler, or the numpy one) on top.
+PIPELINE_MEMORY = 64 << 20
+RESAMPLE_MEMORY = 256 << 20
+# Executable names each tool is looked for under, in order.
+TOOL_NAMES = {
+    "ffmpeg": ("ffmpeg",),
+    "ffprobe": ("ffprobe",),
+    "metaflac": ("metaflac",),
+    "resampler": ("ReSampler",),
+    "flaccl": ("CUETools.FLACCL.cmd.exe", "CUETools.FLACCL.cmd"),
+    "lossywav": ("CUETools.LossyWAV.exe", "CUETools.LossyWAV"),
+}
+
+# Returns audio_bytes (a FLAC file's size without its metadata) as a fraction of the raw PCM size of the track with probe info, or None if its length is unknown.
+def compressionRatio(info, audio_bytes):
+    raw = info["total_samples"] * info["channels"] * info["bits_per_sample"] / 8
+    return audio_bytes / raw if raw > 0 else None
+
+# Raised when a tool is needed but was neither given nor found on PATH.
+class ToolError(Exception):
+    pass
+
+# Where the external binaries are. Tools that are not given are looked for on PATH the first time they are needed, so a run that never resamples never needs ReSampler.
+# cue is the CUETools directory, which holds FLACCL and LossyWAV. Safe to share between worker threads.
+class Tools:
+    def __init__(self, ffmpeg=None, ffprobe=None, metaflac=None, resampler=None, cue=None):
+        self.paths = {name: Path(path) for name, path in (("ffmpeg", ffmpeg), ("ffprobe", ffprobe), ("metaflac", metaflac), ("resampler", resampler)) if path is not None}
+        self.cue = Path(cue) if cue is not None else None
+        self.lock = Lock()
+
+    # Returns the path of a tool (a key of TOOL_NAMES). Raises ToolError if it cannot be found.
+    def path(self, name):
+        with self.lock:
+            if name not in self.paths:
+                self.paths[name] = self.find(name)
+            return self.paths[name]
+
+    # Returns True if a tool was given or can be found.
+    def has(self, name):
+        try:
+            self.path(name)
+            return True
+        except ToolError:
+            return False
+
+    def find(self, name):
+        if self.cue is not None and name in ("flaccl", "lossywav"):
+            return self.cue / TOOL_NAMES[name][0]
+        for candidate in TOOL_NAMES[name]:
+            found = shutil.which(candidate)
+            if found is not None:
+                return Path(found)
+        raise ToolError(f"Cannot find {TOOL_NAMES[name][0]}. Put it on PATH or give its path.")
+
+# What the outputs look like. See Normalize.py for what every option does.
+class Profile:
+    def __init__(self, mode="lossless", resample_mode="original", base_multi=False, resampler_backend="soxr", resampler_threads=1,
+                 cover_mode="smart", cover_max_size=None, replaygain=False, replaygain_engine="native", passthrough="off", passthrough_threshold=2.0):
+        self.mode = mode
+        self.resample_mode = resample_mode
+        self.base_multi = base_multi
+        self.resampler_backend = resampler_backend
+        self.resampler_threads = max(1, resampler_threads)
+        self.cover_mode = cover_mode
+        self.cover_max_size = cover_max_size
+        self.replaygain = replaygain
+        self.replaygain_engine = replaygain_engine
+        # "off", "copy" or "link": what to do with lossless FLAC tracks that re-encoding would shrink by less than passthrough_threshold percent. See Engine.passThrough.
+        self.passthrough = passthrough
+        self.passthrough_threshold = passthrough_threshold
+
+    # Everything that changes what an output file looks like. Outputs made with other settings are converted again.
+    # Passthrough is left out: a passed-through track sounds the same as its re-encode, so turning it on or off converts nothing again.
+    def settings(self):
+        return {"mode": self.mode, "resample_mode": self.resample_mode, "base_multi": self.base_multi, "cover_mode": self.cover_mode,
+                "cover_max_size": self.cover_max_size, "replaygain": self.replaygain and self.replaygain_engine}
+
+    # Returns the sample rate a file with original_rate is converted to, as set by resample_mode and base_multi.
+    def targetSampleRate(self, original_rate):
+        sample_rate = 0
+        if self.resample_mode == "original":
+            sample_rate = original_rate
+        elif self.resample_mode == "base":
+            if self.base_multi:
+                multis = [ceil(original_rate / baserate)*baserate for baserate in BASE_RATES]
+                sample_rate = min(multis)
+            else:
+                sample_rate = BASE_RATES[0]
+                # Loop backwards through baserates
+                for baserate in BASE_RATES[::-1]:
+                    if original_rate % baserate == 0:
+                        sample_rate = baserate
+                        break
+        else:
+            if self.base_multi:
+                sample_rate = ceil(original_rate / int(self.resample_mode))*int(self.resample_mode)
+            else:
+                sample_rate = int(self.resample_mode)
+        return sample_rate
+
+# Converts into one output tree. Safe to share between threads.
+# run() puts tracks through a staged scheduler (probe, resample, encode, tag; see Scheduler.py) with jobs encoders, within memory_budget bytes if given.
+# progress(done, total) is called whenever a track is finished or skipped; total grows as the tree is scanned.
+# Call close() when done, to save the probe cache and the manifest and to clear the scratch directory. With keep_manifest off, no manifest is read or written.
+class Engine:
+    # Files other than tracks are mirrored on asset_jobs threads of their own, as set by asset_mode (see Mirror.MODES).
+    def __init__(self, output_root, profile: Profile, tools: Tools = None, jobs=1, probe_cache_file=None, timing_log=None, temp_root=None, progress=None, asset_mode="auto", asset_jobs=4, memory_budget=None, keep_manifest=True):
+        self.output_root = Path(output_root).absolute()
+        self.profile = profile
+        self.tools = tools if tools is not None else Tools()
+        self.jobs = max(1, jobs)
+        self.memory_budget = memory_budget
+        self.progress = progress
+        if profile.resampler_backend == "resampler":
+            # Fail now rather than on the first track that needs resampling.
+            self.tools.path("resampler")
+        # NumPy is only needed for the built-in resampler and the native replaygain engine, which are imported where they are used. Fail now if it is missing, rather than on the first track.
+        if profile.resampler_backend == "numpy":
+            import Resample
+        if profile.replaygain and profile.replaygain_engine == "native":
+            import ReplayGain
+        self.settings = profile.settings()
+        # Every engine gets its own scratch directory, so several can run at once.
+        temp_root = Path(temp_root) if temp_root is not None else Path(gettempdir()) / ".music_library_normalizer_tmp"
+        temp_root.mkdir(parents=True, exist_ok=True)
+        self.temp_path = Path(mkdtemp(dir=temp_root))
+        # ffprobe is only looked for once a file that is not FLAC turns up.
+        self.probe_cache = ProbeCache(Path(probe_cache_file) if probe_cache_file is not None else None, lambda: self.tools.path("ffprobe"))
+        # Records what every output was made from, so reruns only convert new or changed sources.
+        self.manifest = Manifest(self.output_root, persist=keep_manifest)
+        # Times every stage of every track.
+        self.timer = StageTimer(Path(timing_log) if timing_log is not None else None)
+        # Every unique picture is extracted (and resized) once, into a store of its own.
+        self.artwork = ArtworkStore(self.temp_path / "artwork", profile.cover_max_size)
+        # Analysis of every track converted by this engine, by output file, until its album is finished.
+        self.replaygain_results = {}
+        # Guards total, done, and the progress callback.
+        self.progress_lock = Lock()
+        self.total = 0
+        self.done = 0
+        # Guards encode_rates and passed. The compression ratios of re-encoded tracks (see compressionRatio) are kept in the manifest, so later runs start with them.
+        self.stats_lock = Lock()
+        # Encoding wall time per second of audio, for every eligible track re-encoded so far.
+        self.encode_rates = []
+        # One record (bytes, linked, seconds, audio_seconds, savings) for every track passed through.
+        self.passed = []
+        # Mirrors the files around the tracks (cover art, scans, logs), skipping those already up to date.
+        self.mirror = Mirror(asset_jobs, asset_mode, self.timer)
+        # The stages of a track, by name.
+        self.track_stages = {"probe": self.probeTrack, "resample": self.resampleTrack, "encode": self.encodeTrack, "tag": self.tagStage}
+        # Runs the stages of every track, while run() is going. Kept afterwards for its summary.
+        self.scheduler = None
+
+    def cmd(self, command):
+        with self.timer.time(stageName(command)):
+            return check_output(command, shell=True, text=True, stderr=DEVNULL)
+
+    # Counts tracks found (total) and finished or skipped (done), and reports them.
+    def count(self, total=0, done=0):
+        with self.progress_lock:
+            self.total += total
+            self.done += done
+            if self.progress is not None:
+                self.progress(self.done, self.total)
+
+    # Converts one file into dest, including its album-level steps (as a single: its own album gain, its own cover art). Blocks until done, and converts even if dest is up to date.
+    # dest must be inside the output root.
+    def convert(self, source, dest):
+        source, dest = Path(source).absolute(), Path(dest).absolute()
+        self.count(total=1)
+        self.convertTrack(source, dest, self.singleCover(), alone=True)
+        self.finishSingle(dest)
+        self.manifest.record(source, dest, self.settings)
+        return dest
+
+    # Converts every FLAC file under input_root into the output root, and returns the outputs deleted because their source is gone.
+    # layout "library" classifies directories (albums, singles, multidisc albums; see Scanner.planLibrary) and copies the files around the tracks. layout "files" converts every FLAC file next to its directory mates, and nothing else.
+    # Tracks start converting as soon as their directory has been scanned.
+    def run(self, input_root, layout="library"):
+        input_root = Path(input_root).absolute()
+        plan = planLibrary(input_root, self.output_root, self.probe_cache) if layout == "library" else planFiles(input_root, self.output_root)
+        self.scheduler = self.makeScheduler()
+        try:
+            for entry in plan:
+                self.runEntry(entry)
+            # Wait for every track, re-raising the first failure.
+            self.scheduler.wait()
+        finally:
+            self.scheduler.close()
+        self.mirror.wait()
+        # Outputs whose source is gone are deleted.
+        return self.manifest.prune()
+
+    # Yields the plan for input_root without converting anything: every entry as JSON, with the target sample rate and bit depth of every track, and whether its output is already up to date.
+    def plan(self, input_root, layout="library"):
+        input_root = Path(input_root).absolute()
+        plan = planLibrary(input_root, self.output_root, self.probe_cache) if layout == "library" else planFiles(input_root, self.output_root)
+        for entry in plan:
+            yield self.describeEntry(entry)
+
+    # Saves the probe cache and the manifest, closes the timing log, and clears the scratch directory.
+    # Every step is taken even if one before it fails (a failed cache save must not lose the manifest), and then the first failure is raised.
+    def close(self):
+        errors = []
+        for step in (self.mirror.close, self.probe_cache.save, self.manifest.save, self.timer.close, lambda: shutil.rmtree(self.temp_path, ignore_errors=True)):
+            try:
+                step()
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            raise errors[0]
+
+    # Normalizes the file, and writes its tags and cover(infile) (a stored picture or None; no cover art if cover is None) in one pass. Album gain is left out, since it depends on the whole album, unless the track is alone in its album.
+    # Runs every stage of the track in the calling thread; run() puts tracks through the scheduler instead.
+    def convertTrack(self, infile: Path, outfile: Path, cover=None, alone=False):
+        job = self.newJob(infile, outfile, cover, alone)
+        error = None
+        try:
+            stage = "probe"
+            while stage is not None:
+                stage = self.track_stages[stage](job)
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            self.trackDone(job, error)
+
+    # Returns the job for a track: everything its stages need and find out, passed from one stage to the next.
+    def newJob(self, infile: Path, outfile: Path, cover, alone):
+        # Every track gets its own scratch directory, so several tracks can be converted at once.
+        return {"infile": infile, "outfile": outfile, "cover": cover, "alone": alone, "temp_path": Path(mkdtemp(dir=self.temp_path)), "started": perf_counter(),
+                # The fields of the track's timing record.
+                "timing": {"track": str(infile), "bytes_in": infile.stat().st_size}}
+
+    # Ends a track, after its last stage or a failure (error): clears its scratch directory, and records how long it took, from its probe to its tags.
+    def trackDone(self, job, error):
+        # Clear all files in this job's temp directory.
+        shutil.rmtree(job["temp_path"], ignore_errors=True)
+        timing = job["timing"]
+        if error is None:
+            timing["bytes_out"] = job["outfile"].stat().st_size
+        else:
+            timing["ok"] = False
+        self.timer.record("track", perf_counter() - job["started"], **timing)
+        if error is None:
+            self.count(done=1)
+
+    # Returns the scheduler for run(): bounded queues and workers for each stage of a track, with jobs encoders (see Scheduler.py).
+    def makeScheduler(self):
+        return StagedScheduler([
+            Stage("probe", self.probeTrack, workers=1, max_workers=PROBE_WORKERS),
+            Stage("resample", self.resampleTrack, workers=1, max_workers=self.jobs, cost=lambda job: RESAMPLE_MEMORY),
+            Stage("encode", self.encodeTrack, workers=self.jobs, min_workers=self.jobs, cost=self.encodeMemory),
+            Stage("tag", self.tagStage, workers=1, max_workers=TAG_WORKERS),
+        ], "encode", self.memory_budget)
+
+    # Memory an encode needs: its processes and pipes, plus the in-process resampler if it has one.
+    def encodeMemory(self, job):
+        return PIPELINE_MEMORY + (RESAMPLE_MEMORY if job["resample"] and self.profile.resampler_backend == "numpy" else 0)
+
+    # The stages of a track. Each takes the track's job, does its part, and returns the name of the next stage, or None when the track is done.
+
+    # Probes the source, and works out what the track needs: resampling, analysis, or only passing through.
+    def probeTrack(self, job):
+        profile = self.profile
+        infile = job["infile"]
+        timing = job["timing"]
+        # Check if input file is a FLAC file. Store as a boolean.
+        job["is_flac"] = is_flac = infile.suffix == ".flac"
+
+        #
+        # Get target sample rate for this file.
+        #
+        # Stream info and tags come from a single (cached) probe.
+        with self.timer.time("probe", track=str(infile)):
+            info = job["info"] = self.probe_cache.probe(infile)
+        original_rate = info["sample_rate"]
+        timing["audio_seconds"] = info["total_samples"] / original_rate if info["total_samples"] else None
+        job["sample_rate"] = sample_rate = profile.targetSampleRate(original_rate)
+        job["resample"] = resample = profile.resample_mode != "original" and sample_rate != original_rate
+        # With native replaygain, the track is measured from the PCM on its way into FLACCL.
+        job["analysis"] = [] if profile.replaygain and profile.replaygain_engine == "native" else None
+        # What the encode stage reads: the source, a file from the resample stage, or "-" for the output of its own decoder.
+        job["source"] = str(infile)
+        # Lossless FLAC at its own rate can be passed through instead of re-encoded, when re-encoding tracks like it has been seen to compress them barely better than this one already is.
+        job["eligible"] = profile.passthrough != "off" and is_flac and profile.mode == "lossless" and not resample and "audio_offset" in info and info["total_samples"] > 0
+        if job["eligible"]:
+            savings = self.expectedSavings(info, timing["bytes_in"])
+            if savings is not None and savings * 100 < profile.passthrough_threshold:
+                job["passthrough"] = savings
+                return "tag"
+        return "resample" if resample and profile.resampler_backend == "resampler" else "encode"
+
+    # Resamples with ReSampler, which cannot read from or write to a pipe, so this is the only case where audio goes through temp WAVs.
+    def resampleTrack(self, job):
+        infile, info, temp_path = job["infile"], job["info"], job["temp_path"]
+        # BUG: Filename errors for special characters. Rename infile to current.flac and restore to original name after resampling.
+        re_infile = infile
+        # If input file is not FLAC, convert infile to temp1.wav (as re_infile) with the same sample rate as original file.
+        if not job["is_flac"]:
+            re_infile = temp_path / "temp1.wav"
+            self.cmd(f"{self.tools.path('ffmpeg')} -i \"{infile}\" -ar {info['sample_rate']} \"{re_infile}\"")
+        job["source"] = source = str(temp_path / "temp2.wav")
+        self.cmd(f"\"{self.tools.path('resampler')}\" -i \"{re_infile}\" -o \"{source}\" -r {job['sample_rate']} --mt --doubleprecision -b {info['bits_per_sample']}")
+        if job["analysis"] is not None and self.profile.mode == "lossless":
+            from ReplayGain import analyzeWavFile
+            # ReSampler's WAV goes straight into FLACCL, so measure it from the file.
+            job["analysis"].append(analyzeWavFile(source))
+        return "encode"
+
+    # Decodes, resamples (with soxr or numpy), quantizes and compresses the track, as stages of a single streaming pipeline, so no intermediate WAV files are written.
+    def encodeTrack(self, job):
+        profile = self.profile
+        mode = profile.mode
+        infile, outfile, info, timing = job["infile"], job["outfile"], job["info"], job["timing"]
+        original_rate, sample_rate, resample = info["sample_rate"], job["sample_rate"], job["resample"]
+        analysis = job["analysis"]
+        analyze = analysis is not None
+
+        #
+        # Get the bit depth of input file.
+        #
+        bit_depth = info["bits_per_sample"]
+
+        #
+        # Build the conversion pipeline.
+        #
+        # Default to 24 bits in the worst case. Theoretically doesn't matter because of the wasted_bits field.
+        pcm_format = "pcm_s16le" if bit_depth == 16 else "pcm_s24le"
+        stages = []
+        source = job["source"] # What the next stage reads: a file, or "-" for the previous stage's output.
+        if resample and profile.resampler_backend == "resampler":
+            # The resample stage has already written it.
+            pass
+        elif resample and profile.resampler_backend == "numpy":
+            from Resample import ResampleStage
+            # Decode to raw 32-bit samples, and resample them in-process into a WAV for the next stage.
+            stages.append([str(self.tools.path("ffmpeg")), "-v", "error", "-i", str(infile), "-map", "0:a:0", "-map_metadata", "-1", "-c:a", "pcm_s32le", "-f", "s32le", "-"])
+            # Only FLAC's length is exact; for anything else the WAV sizes are left unknown.
+            stages.append(ResampleStage(info["channels"], original_rate, sample_rate, 16 if bit_depth == 16 else 24, info["total_samples"] if job["is_flac"] else None, profile.resampler_threads))
+            source = "-"
+        elif resample or not job["is_flac"] or mode != "lossless" or analyze:
+            # Decode to WAV on stdout, resampling with ffmpeg's SoX resampler if needed.
+            decode = [str(self.tools.path("ffmpeg")), "-v", "error", "-i", str(infile), "-map", "0:a:0", "-map_metadata", "-1"]
+            if resample:
+                decode += ["-af", f"aresample={sample_rate}:resampler=soxr:precision=28"]
+            decode += ["-c:a", pcm_format, "-f", "wav", "-"]
+            stages.append(decode)
+            source = "-"
+        # else: FLACCL reads the FLAC directly.
+
+        #
+        # Quantization and compression step
+        #
+        if mode != "lossless":
+            stages.append([str(self.tools.path("lossywav")), source, f"-{mode}", "--stdout"])
+        if analyze and stages:
+            from ReplayGain import AnalyzeStage
+            stages.append(AnalyzeStage(analysis.append))
+        flaccl = [str(self.tools.path("flaccl")), "-o", str(outfile), "--lax", "-11"]
+        if source == "-" and mode == "lossless":
+            # ffmpeg cannot fill in the WAV chunk sizes when writing to a pipe.
+            flaccl.append("--ignore-chunk-sizes")
+        stages.append(flaccl + ["-" if stages else source])
+        # Create outfile's directory recursively, if it doesn't exist
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        # An old output may be a hard link to its source; the encoder must not write through it.
+        outfile.unlink(missing_ok=True)
+        try:
+            timings = runPipeline(stages)
+        except PipelineError:
+            # Don't leave a truncated output behind.
+            outfile.unlink(missing_ok=True)
+            raise
+        # Every stage sees the whole track go by, so each is credited with the source's size and length. Only the encoder knows the output size.
+        for index, (command, seconds) in enumerate(timings):
+            self.timer.record(stageName(command), seconds, track=str(infile), bytes_in=timing["bytes_in"], bytes_out=outfile.stat().st_size if index == len(timings) - 1 else None, audio_seconds=timing["audio_seconds"])
+        if job["eligible"]:
+            # Learn how well FLACCL compresses tracks like this one, and how long it takes. Metadata is left out of the size.
+            ratio = compressionRatio(info, outfile.stat().st_size - readFlac(outfile)["audio_offset"])
+            if ratio is not None:
+                self.manifest.recordCompressionRatio((info["vendor"], info["sample_rate"], info["bits_per_sample"]), ratio)
+            with self.stats_lock:
+                if timing["audio_seconds"]:
+                    # The stages run at the same time, so the slowest one is the pipeline's wall time.
+                    self.encode_rates.append(max(seconds for _, seconds in timings) / timing["audio_seconds"])
+        return "tag"
+
+    # Writes the track's tags, replaygain and cover art, or passes it through if the probe stage decided so.
+    def tagStage(self, job):
+        infile, outfile, info = job["infile"], job["outfile"], job["info"]
+        if "passthrough" in job:
+            self.passThrough(infile, outfile, info, job["timing"], job["cover"], job["alone"], job["passthrough"])
+        else:
+            analysis = job["analysis"]
+            self.tagTrack(infile, outfile, info, analysis[0] if analysis else None, job["cover"], job["alone"])
+        return None
+
+    # Writes the tags of a converted track: those of its source, its replaygain (track gain from analysis, and album gain too if it is alone in its album) and its cover art.
+    # strip_pictures removes any pictures outfile has when cover gives none.
+    def tagTrack(self, infile, outfile, info, analysis, cover, alone, strip_pictures=False):
+        picture = cover(infile) if cover is not None else None
+        if analysis is not None:
+            from ReplayGain import trackGain, albumGain, replayGainTags
+            # Copy tags from infile to outfile, replacing the old replaygain tags with the track gain just measured. Album gain is added once the album is finished, or now if the track is an album of its own.
+            extra_tags = replayGainTags("TRACK", *trackGain(analysis))
+            if alone:
+                extra_tags.update(replayGainTags("ALBUM", *albumGain([analysis])))
+            else:
+                self.replaygain_results[outfile] = analysis
+            self.writeTags(info, outfile, extra_tags, picture=picture, strip_pictures=strip_pictures)
+        else:
+            # Copy tags from infile to outfile. With replaygain, the old replaygain tags are left behind; the album-level step adds new ones.
+            self.writeTags(info, outfile, {}, keep_replaygain=not self.profile.replaygain, picture=picture, strip_pictures=strip_pictures)
+
+    # Writes the tags of the source (from its probe) to outfile, plus extra_tags, and picture (a stored picture) as its only cover art if given. Replaygain tags of the source are left out unless keep_replaygain is set.
+    # Without a picture, the pictures outfile has are kept, or removed if strip_pictures is set.
+    # Everything is written natively in one pass, in place if the encoder left enough padding.
+    def writeTags(self, info, outfile, extra_tags, keep_replaygain=False, picture=None, strip_pictures=False):
+        tags = {name: values for name, values in info["tags"].items() if keep_replaygain or not name.startswith("REPLAYGAIN_")}
+        tags.update((name, [value]) for name, value in extra_tags.items())
+        pictures = [self.artwork.block(picture)] if picture is not None else [] if strip_pictures else None
+        with self.timer.time("write tags", track=str(outfile)):
+            writeFlac(outfile, tags=tags, pictures=pictures)
+
+    # Returns the fraction of its audio bytes that re-encoding a track (its probe info, and its size) is expected to save: its own compression ratio against the median that FLACCL achieved on tracks of the same encoder, sample rate and bit depth.
+    # Returns None until PASSTHROUGH_SAMPLES of those have been re-encoded, in this run or earlier ones into the same output tree. Each track is judged by its own ratio, so a poorly compressed rip is re-encoded even if its encoder's other rips are passed through.
+    def expectedSavings(self, info, size):
+        ratio = compressionRatio(info, size - info["audio_offset"])
+        samples = self.manifest.compressionRatios((info["vendor"], info["sample_rate"], info["bits_per_sample"]))
+        achieved = percentile(samples, 50) if len(samples) >= PASSTHROUGH_SAMPLES else None
+        return 1 - achieved / ratio if achieved is not None and ratio else None
+
+    # Puts infile in place of its re-encode, which would only have been smaller by the fraction savings.
+    # With passthrough "link", outfile is a hard link to infile when it would be the same file anyway: replaygain is not recalculated, and the track gets the cover art it already has, unresized (or none, and has none).
+    # Otherwise (or if infile cannot be linked, such as across filesystems) infile is copied, and its tags, replaygain and cover art written as for a conversion.
+    def passThrough(self, infile, outfile, info, timing, cover, alone, savings):
+        profile = self.profile
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        outfile.unlink(missing_ok=True)
+        start = perf_counter()
+        with self.timer.time("passthrough", track=str(infile), bytes_in=timing["bytes_in"], audio_seconds=timing["audio_seconds"]) as fields:
+            linked = False
+            if profile.passthrough == "link" and not profile.replaygain:
+                picture = cover(infile) if cover is not None else None
+                # A resized picture is not the one the source has.
+                if picture == (self.ownCover(infile) if info["pictures"] else None) and (picture is None or profile.cover_max_size is None):
+                    try:
+                        os.link(infile, outfile)
+                        linked = True
+                    except OSError:
+                        pass
+            if not linked:
+                # A reflink shares the source's blocks until the tags are written, where the filesystem can.
+                if not reflink(infile, outfile):
+                    shutil.copyfile(infile, outfile)
+                analysis = None
+                if profile.replaygain and profile.replaygain_engine == "native":
+                    from ReplayGain import analyzeFile
+                    with self.timer.time("replaygain analysis", track=str(infile), bytes_in=timing["bytes_in"]):
+                        analysis = analyzeFile(self.tools.path("ffmpeg"), infile)
+                self.tagTrack(infile, outfile, info, analysis, cover, alone, strip_pictures=True)
+            fields["linked"] = linked
+        with self.stats_lock:
+            self.passed.append({"bytes": timing["bytes_in"], "linked": linked, "seconds": perf_counter() - start, "audio_seconds": timing["audio_seconds"], "savings": savings})
+
+    # Returns the end-of-run summary as lines of text: stage timings, the scheduler, what passthrough saved and how the other files were mirrored.
+    def summary(self):
+        return self.timer.summary() + (self.scheduler.summary() if self.scheduler is not None else []) + self.passthroughSummary() + self.mirror.summary()
+
+    # Returns what passing tracks through saved, as lines of text for the end of the run, or no lines if none were.
+    def passthroughSummary(self):
+        with self.stats_lock:
+            passed = list(self.passed)
+            encode_rates = list(self.encode_rates)
+        if not passed:
+            return []
+        source_bytes = sum(track["bytes"] for track in passed)
+        linked_bytes = sum(track["bytes"] for track in passed if track["linked"])
+        lines = [f"Passed {len(passed)} tracks through without re-encoding: {source_bytes / 1e6:.1f} MB not re-encoded, {linked_bytes / 1e6:.1f} MB of it hard-linked instead of written."]
+        if encode_rates:
+            # Their audio would have been encoded at the median rate of the tracks that were re-encoded.
+            encode_seconds = sum(track["audio_seconds"] or 0 for track in passed) * percentile(encode_rates, 50)
+            lines.append(f"Time saved: about {encode_seconds - sum(track['seconds'] for track in passed):.1f} s of encoding. Output size compared with re-encoding: about {sum(track['bytes'] * track['savings'] for track in passed) / 1e6:+.1f} MB.")
+        return lines
+
+    # Calculates album replaygain over outfiles, which make up one album (or single).
+    def addAlbumGain(self, outfiles):
+        if self.profile.replaygain_engine == "metaflac":
+            quoted = " ".join(f"\"{outfile}\"" for outfile in outfiles)
+            self.cmd(f"{self.tools.path('metaflac')} --add-replay-gain {quoted}")
+            return
+        from ReplayGain import albumGain, replayGainTags
+        # Tracks converted by this engine were measured on the way; any others are decoded and measured now.
+        results = [self.replaygain_results.pop(outfile, None) or self.analyzeTrack(outfile) for outfile in outfiles]
+        album_tags = {name: [value] for name, value in replayGainTags("ALBUM", *albumGain(results)).items()}
+        # The tags are written natively, into the padding left when the track's own tags were written.
+        for outfile in outfiles:
+            with self.timer.time("album gain", track=str(outfile)):
+                tags = readFlac(outfile)["tags"]
+                tags.update(album_tags)
+                writeFlac(outfile, tags=tags)
+
+    # Measures an output that was not converted by this engine, for its album's gain.
+    def analyzeTrack(self, outfile):
+        from ReplayGain import analyzeFile
+        with self.timer.time("replaygain analysis", track=str(outfile), bytes_in=outfile.stat().st_size):
+            return analyzeFile(self.tools.path("ffmpeg"), outfile)
+
+    # Submits every track of an album that is not up to date in the manifest to the scheduler.
+    # finish(converted) runs once, in the worker that completes the last track, and only if no track failed. The converted tracks are recorded in the manifest after that, so an album interrupted before its album-level steps is converted again.
+    # cover and alone are passed on to convertTrack.
+    def submitAlbum(self, tracks, finish=None, cover=None, alone=False):
+        converted = [(infile, outfile) for infile, outfile in tracks if not self.manifest.isCurrent(infile, outfile, self.settings)]
+        self.count(total=len(tracks), done=len(tracks) - len(converted))
+        if not converted:
+            return
+        remaining = len(converted)
+        failed = False
+        album_lock = Lock()
+        def done(job, error):
+            nonlocal remaining, failed
+            self.trackDone(job, error)
+            with album_lock:
+                remaining -= 1
+                failed = failed or error is not None
+                last = remaining == 0 and not failed
+            if last:
+                if finish is not None:
+                    finish(converted)
+                for done_infile, done_outfile in converted:
+                    self.manifest.record(done_infile, done_outfile, self.settings)
+        for infile, outfile in converted:
+            self.scheduler.submit(self.newJob(infile, outfile, cover, alone), done)
+
+    # Returns the stored copy of the cover art embedded in infile, or None if it has none. The picture comes from the artwork store, so it is only extracted once however many files share it.
+    def ownCover(self, infile):
+        with self.timer.time("cover art", track=str(infile)):
+            return self.artwork.extract(infile, self.probe_cache.probe(infile))
+
+    # Returns the cover function for a single: its own cover art, unless cover_mode is "separate".
+    def singleCover(self):
+        return self.ownCover if self.profile.cover_mode == "embed" or self.profile.cover_mode == "smart" else None
+
+    # Album-level steps for a single, which is an album of its own. Its cover art, and native album gain, were written together with its tags.
+    def finishSingle(self, outfile):
+        if self.profile.replaygain and self.profile.replaygain_engine == "metaflac":
+            # Calculate replaygain for this file only.
+            self.addAlbumGain([outfile])
+
+    # Converts one entry of a plan (see Scanner). The scanner has already classified the directory and listed its files, so nothing here lists the directory again.
+    def runEntry(self, entry):
+        profile = self.profile
+        input_path = entry["input"]
+        output_path = entry["output"]
+        tracks = entry["tracks"]
+        files = entry["files"]
+        # Create the output directory.
+        output_path.mkdir(parents=True, exist_ok=True)
+        match entry["kind"]:
+            # If this directory is an album, normalize all FLAC files in the directory.
+            case "album":
+                # In "smart" and "separate" mode, the cover art stays in the directory (and is copied over with the other files) and the tracks get none.
+                # If "embed" is specified, every track gets the cover art (first .jpg, or else the picture embedded in the first track), written together with its tags.
+                covers = [file for file in entry["files"] if file.suffix == ".jpg"]
+                def albumCover(infile):
+                    with self.timer.time("cover art", track=str(infile)):
+                        return self.artwork.add(covers[0]) if covers else self.artwork.extract(tracks[0][0], self.probe_cache.probe(tracks[0][0]))
+                # Album-level steps, run once every track of the album has finished.
+                def finishAlbum(converted):
+                    # Album gain depends on every track, so it is recalculated on the whole album even if only some tracks were converted.
+                    if profile.replaygain:
+                        self.addAlbumGain([outfile for _, outfile in tracks])
+                    # else: replaygain was already copied over.
+                    if profile.cover_mode == "embed" and albumCover(tracks[0][0]) is None:
+                        printerr(f"WARNING: cover_mode=embed specified and {input_path} has no cover art. Not embedding cover art.")
+                self.submitAlbum(tracks, finishAlbum, albumCover if profile.cover_mode == "embed" else None)
+            # If this directory is an artist directory, normalize every single in it as an album of its own. Its subdirectories are entries of their own.
+            case "singles":
+                for infile, outfile in tracks:
+                    self.submitAlbum([(infile, outfile)], lambda converted, outfile=outfile: self.finishSingle(outfile), self.singleCover(), alone=True)
+                if profile.cover_mode == "separate":
+                    printerr(f"WARNING: cover_mode=separate specified and {input_path} has singles. Not copying cover art.")
+            # Only one single in this directory.
+            case "single":
+                flac_file, outfile = tracks[0]
+                self.submitAlbum([(flac_file, outfile)], lambda converted: self.finishSingle(outfile), self.singleCover(), alone=True)
+                if profile.cover_mode == "separate" and self.probe_cache.probe(flac_file)["pictures"]:
+                    # Export the embedded cover art as cover.jpg, on every run, whether or not the track is converted. It takes the place of a cover.jpg already in the directory.
+                    if any(file.name.lower() == "cover.jpg" for file in files):
+                        printerr(f"WARNING: cover_mode=separate specified and {input_path} already has a cover.jpg. Exporting the embedded cover art in its place.")
+                        files = [file for file in files if file.name.lower() != "cover.jpg"]
+                    self.mirror.run(self.exportCover, flac_file, output_path / "cover.jpg")
+            # No FLAC files in this directory (a multidisc album): the discs are entries of their own.
+            case "multidisc":
+                pass
+            # FLAC files that are not grouped into albums: every track is an album of its own, and keeps its own cover art.
+            case "files":
+                def finishFiles(converted):
+                    for _, outfile in converted:
+                        self.finishSingle(outfile)
+                self.submitAlbum(tracks, finishFiles, self.singleCover(), alone=True)
+        # Mirror all non-flac files to the output directory. With cover_max_size, pictures are scaled down on the way, as embedded ones are.
+        for file in files:
+            if profile.cover_max_size is not None and file.suffix.lower() in PICTURE_SUFFIXES:
+                self.mirror.run(self.mirrorPicture, file, output_path / file.name)
+            else:
+                self.mirror.submit(file, output_path / file.name)
+
+    # Mirrors a picture file to dest through the artwork store, which scales it down to cover_max_size. Runs on the mirror's threads.
+    def mirrorPicture(self, file, dest):
+        with self.timer.time("cover art", track=str(file)):
+            picture = self.artwork.add(file)
+        if picture.stat().st_size == file.stat().st_size:
+            # Small enough already: mirrored as it is, so it can still be linked.
+            self.mirror.mirror(file, dest, compare_contents=False)
+        else:
+            # Recompressed as JPEG. The stored picture is written anew every run, so only its contents tell whether the copy is up to date.
+            self.mirror.mirror(picture, dest.with_suffix(picture.suffix), compare_contents=True)
+
+    # Mirrors the cover art embedded in infile to dest. Runs on the mirror's threads.
+    def exportCover(self, infile, dest):
+        picture = self.ownCover(infile)
+        if picture is not None:
+            # The stored picture is written anew every run, so only its contents tell whether the copy is up to date.
+            self.mirror.mirror(picture, dest, compare_contents=True)
+
+    # Returns a plan entry as JSON: the entry, plus the target sample rate and bit depth of every track, and whether its output is already up to date.
+    def describeEntry(self, entry):
+        described = entryToJSON(entry)
+        for track, (infile, outfile) in zip(described["tracks"], entry["tracks"]):
+            info = self.probe_cache.probe(infile)
+            track["sample_rate"] = self.profile.targetSampleRate(info["sample_rate"])
+            track["bits_per_sample"] = 16 if info["bits_per_sample"] == 16 else 24
+            track["up_to_date"] = self.manifest.isCurrent(infile, outfile, self.settings)
+        return described
+
+# Converts one file into dest with profile (the default profile if None): a lossless FLACCL encode with tags and cover art copied over. Returns dest.
+# options are passed on to Engine. No manifest is kept, since a one-off conversion never checks one.
+def convert(source, dest, profile: Profile = None, tools: Tools = None, **options):
+    engine = Engine(Path(dest).absolute().parent, profile if profile is not None else Profile(), tools, keep_manifest=False, **options)
+    try:
+        return engine.convert(source, dest)
+    finally:
+        engine.close()
@@ -0,0 +1,242 @@
+# Native reader and writer for FLAC metadata blocks.
+# Reads STREAMINFO, VORBIS_COMMENT and the headers of PICTURE blocks straight from the file, without launching metaflac or ffprobe.
+# Only the metadata blocks at the start of the file are read; the audio frames are never touched, and picture data is skipped unless asked for.
+# Writes tags and pictures in one pass, in place when they fit in the space the old blocks and padding took, so the audio frames are only copied when the metadata outgrows it.
+
+from threading import get_ident
+import os
+import shutil
+import struct
+
+# Metadata block types, as numbered by the FLAC format.
+STREAMINFO = 0
+PADDING = 1
+APPLICATION = 2
+SEEKTABLE = 3
+VORBIS_COMMENT = 4
+CUESHEET = 5
+PICTURE = 6
+
+# Room left for metadata to grow when a file has to be rewritten, so later changes (such as album gain) are written in place.
+DEFAULT_PADDING = 8192
+# Largest body a metadata block can have (24-bit length).
+MAX_BLOCK_LENGTH = (1 << 24) - 1
+
+# Raised when a file is not a FLAC file, or its metadata blocks are damaged.
+class FlacError(Exception):
+    pass
+
+# Yields (block_type, is_last, length, offset of the block body) for every metadata block in an open FLAC file.
+def iterBlocks(f):
+    if f.read(4) != b"fLaC":
+        raise FlacError(f"{getattr(f, 'name', 'file')} is not a FLAC file.")
+    offset = 4
+    while True:
+        header = f.read(4)
+        if len(header) != 4:
+            raise FlacError(f"{getattr(f, 'name', 'file')} ends inside its metadata blocks.")
+        is_last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], "big")
+        offset += 4
+        yield block_type, is_last, length, offset
+        offset += length
+        f.seek(offset)
+        if is_last:
+            return
+
+# Parses a STREAMINFO block body.
+def parseStreamInfo(body):
+    if len(body) < 34:
+        raise FlacError("STREAMINFO block is too short.")
+    # 20 bits sample rate, 3 bits (channels - 1), 5 bits (bits per sample - 1), 36 bits total samples.
+    packed = int.from_bytes(body[10:18], "big")
+    return {
+        "min_blocksize": int.from_bytes(body[0:2], "big"),
+        "max_blocksize": int.from_bytes(body[2:4], "big"),
+        "sample_rate": packed >> 44,
+        "channels": ((packed >> 41) & 0x7) + 1,
+        "bits_per_sample": ((packed >> 36) & 0x1F) + 1,
+        "total_samples": packed & 0xFFFFFFFFF,
+        "md5": body[18:34].hex(),
+    }
+
+# Parses a VORBIS_COMMENT block body into (vendor, tags). Tag names are upper-cased, and every name maps to a list of values.
+def parseVorbisComment(body):
+    try:
+        vendor_length, = struct.unpack_from("<I", body, 0)
+        vendor = body[4:4 + vendor_length].decode("utf-8", "replace")
+        position = 4 + vendor_length
+        count, = struct.unpack_from("<I", body, position)
+        position += 4
+        tags = {}
+        for _ in range(count):
+            length, = struct.unpack_from("<I", body, position)
+            position += 4
+            comment = body[position:position + length].decode("utf-8", "replace")
+            position += length
+            name, _, value = comment.partition("=")
+            tags.setdefault(name.upper(), []).append(value)
+    except struct.error:
+        raise FlacError("VORBIS_COMMENT block is damaged.")
+    return vendor, tags
+
+# Parses the header of a PICTURE block body. The picture data itself is included only if with_data is set.
+def parsePicture(body, with_data=False):
+    try:
+        picture_type, mime_length = struct.unpack_from(">II", body, 0)
+        position = 8
+        mime = body[position:position + mime_length].decode("ascii", "replace")
+        position += mime_length
+        description_length, = struct.unpack_from(">I", body, position)
+        position += 4
+        description = body[position:position + description_length].decode("utf-8", "replace")
+        position += description_length
+        width, height, depth, colors, data_length = struct.unpack_from(">IIIII", body, position)
+        position += 20
+    except struct.error:
+        raise FlacError("PICTURE block is damaged.")
+    picture = {
+        "type": picture_type,
+        "mime": mime,
+        "description": description,
+        "width": width,
+        "height": height,
+        "depth": depth,
+        "colors": colors,
+        "data_length": data_length,
+    }
+    if with_data:
+        picture["data"] = bytes(body[position:position + data_length])
+    return picture
+
+# Reads the metadata of a FLAC file. Returns a dict with the STREAMINFO fields, "vendor", "tags", "pictures" and "audio_offset" (where the first audio frame starts).
+# Picture data is only read if pictures is set; otherwise picture blocks are seeked over, so only the first few KB of the file are read.
+def readFlac(path, pictures=False):
+    info = {"vendor": "", "tags": {}, "pictures": []}
+    with open(path, "rb") as f:
+        for block_type, is_last, length, offset in iterBlocks(f):
+            if block_type == STREAMINFO:
+                info.update(parseStreamInfo(f.read(length)))
+            elif block_type == VORBIS_COMMENT:
+                info["vendor"], info["tags"] = parseVorbisComment(f.read(length))
+            elif block_type == PICTURE:
+                if pictures:
+                    body = f.read(length)
+                else:
+                    # The picture header is small; read just enough of it to get past the MIME type and description.
+                    body = f.read(min(length, 4096))
+                    if len(body) < length and not fitsPictureHeader(body):
+                        body += f.read(length - len(body))
+                picture = parsePicture(body, pictures)
+                picture["offset"] = offset
+                picture["length"] = length
+                info["pictures"].append(picture)
+            if is_last:
+                info["audio_offset"] = offset + length
+    if "sample_rate" not in info:
+        raise FlacError(f"{path} has no STREAMINFO block.")
+    return info
+
+# Returns True if body holds the whole fixed part of a PICTURE block header.
+def fitsPictureHeader(body):
+    try:
+        mime_length, = struct.unpack_from(">I", body, 4)
+        description_length, = struct.unpack_from(">I", body, 8 + mime_length)
+        return len(body) >= 12 + mime_length + description_length + 20
+    except struct.error:
+        return False
+
+# Returns the body of a VORBIS_COMMENT block. tags maps names to lists of values.
+def makeVorbisComment(vendor, tags):
+    vendor = vendor.encode("utf-8")
+    comments = [f"{name}={value}".encode("utf-8") for name, values in tags.items() for value in values]
+    return struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(comments)) + b"".join(struct.pack("<I", len(comment)) + comment for comment in comments)
+
+# Returns the body of a PICTURE block holding an image (a front cover, by default). Size and depth are read from the image itself for JPEG and PNG.
+def makePicture(data, picture_type=3, description=""):
+    mime, width, height, depth = imageInfo(data)
+    mime = mime.encode("ascii")
+    description = description.encode("utf-8")
+    return (struct.pack(">II", picture_type, len(mime)) + mime + struct.pack(">I", len(description)) + description
+            + struct.pack(">IIIII", width, height, depth, 0, len(data)) + data)
+
+# Returns (MIME type, width, height, bits per pixel) of an image. Width, height and depth are 0 where they cannot be read.
+def imageInfo(data):
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 26:
+        width, height, bit_depth, color_type = struct.unpack_from(">IIBB", data, 16)
+        # Samples per pixel, by PNG color type.
+        samples = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type, 1)
+        return "image/png", width, height, bit_depth * samples
+    if data[:2] != b"\xff\xd8":
+        return "image/", 0, 0, 0
+    # Walk the JPEG markers up to the first start-of-frame, which holds the size.
+    position = 2
+    while position + 9 < len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte.
+            position += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            precision, height, width, components = struct.unpack_from(">BHHB", data, position + 4)
+            return "image/jpeg", width, height, precision * components
+        position += 2 + int.from_bytes(data[position + 2:position + 4], "big")
+    return "image/jpeg", 0, 0, 0
+
+# Returns a metadata block header followed by its body.
+def blockBytes(block_type, body, is_last=False):
+    if len(body) > MAX_BLOCK_LENGTH:
+        raise FlacError(f"Metadata block of type {block_type} is too large ({len(body)} bytes).")
+    return bytes([block_type | (0x80 if is_last else 0)]) + len(body).to_bytes(3, "big") + body
+
+# Replaces the tags and/or pictures of a FLAC file in one pass.
+# tags maps names to lists of values and replaces every tag; pictures is a list of PICTURE block bodies (see makePicture) and replaces every picture. None leaves them as they are. vendor None keeps the file's vendor string.
+# Every other block is kept. If the new blocks fit in the space the old ones took, padding included, they are written in place; otherwise the file is rewritten once, with DEFAULT_PADDING of room for the next change.
+def writeFlac(path, tags=None, pictures=None, vendor=None):
+    blocks = []
+    with open(path, "rb") as f:
+        for block_type, is_last, length, offset in iterBlocks(f):
+            if is_last:
+                audio_offset = offset + length
+            if block_type == PADDING or (block_type == PICTURE and pictures is not None):
+                continue
+            body = f.read(length)
+            if block_type == VORBIS_COMMENT and (tags is not None or vendor is not None):
+                old_vendor, old_tags = parseVorbisComment(body)
+                body = makeVorbisComment(vendor if vendor is not None else old_vendor, tags if tags is not None else old_tags)
+                tags = vendor = None
+            blocks.append((block_type, body))
+    if not blocks or blocks[0][0] != STREAMINFO:
+        raise FlacError(f"{path} has no STREAMINFO block.")
+    if tags is not None or vendor is not None:
+        # The file had no VORBIS_COMMENT block.
+        blocks.append((VORBIS_COMMENT, makeVorbisComment(vendor or "", tags or {})))
+    blocks += [(PICTURE, picture) for picture in pictures or ()]
+    metadata = b"".join(blockBytes(block_type, body) for block_type, body in blocks)
+    space = audio_offset - 4
+    if len(metadata) == space:
+        # Fits exactly: the last block is flagged as such, with no padding after it.
+        last_type, last_body = blocks[-1]
+        metadata = metadata[:-len(last_body) - 4] + blockBytes(last_type, last_body, True)
+        with open(path, "r+b") as f:
+            f.seek(4)
+            f.write(metadata)
+    elif len(metadata) + 4 <= space:
+        # Fits with room to spare, which becomes the padding.
+        with open(path, "r+b") as f:
+            f.seek(4)
+            f.write(metadata + blockBytes(PADDING, bytes(space - len(metadata) - 4), True))
+    else:
+        # Written under a unique name and renamed, so the file is never left half-written.
+        temp_file = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        try:
+            with open(path, "rb") as source, open(temp_file, "wb") as f:
+                f.write(b"fLaC" + metadata + blockBytes(PADDING, bytes(DEFAULT_PADDING), True))
+                source.seek(audio_offset)
+                shutil.copyfileobj(source, f, 1 << 20)
+            os.replace(temp_file, path)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
@@ -1,33 +1,56 @@
-from pathlib import Path, PurePath
-from pyprog import ProgressBar
-from os import system as cmd
-from os import chdir as cd
-from os import makedirs
-from os.path import exists, dirname
-from time import sleep
+# Converts every FLAC file under a directory to FLAC with FLACCL, keeping tags and embedded cover art.
+# Usage: -i <input directory> -o <output directory> --cue <path to CUETools> --ffmpeg <path to ffmpeg> --ffprobe <path to ffprobe> --passthrough <off/copy/link> --passthrough-threshold <percent> --jobs <N> --timing-log <path to JSON lines file>
+# Input and output directories are prompted for if not given. Tools that are not given are looked for on PATH.
+# --passthrough copies or hard-links files that re-encoding would barely shrink, instead of re-encoding them (see Normalize.py).
+# The conversion itself is done by Engine.py; see Normalize.py for a script with every option.
 
-FFmpeg = PurePath(r"C:\ProgramData\chocolatey\bin\ffmpeg.exe")
-CUETools = PurePath(r"S:\CUETools_2.2.2")
-metaflac = PurePath(r"C:\ProgramData\chocolatey\bin\metaflac.exe")
-in_dir = Path(input("Input Directory: "))
-out_dir = Path(input("Output Directory: "))
-in_flacs = tuple(in_dir.glob("**/*.flac"))
-out_flacs = tuple([Path(str(out_dir)+"\\"+str(flac.relative_to(in_dir))) for flac in in_flacs])
-assert len(in_flacs) == len(out_flacs)
-flacs = tuple(zip(in_flacs, out_flacs))
-progress = ProgressBar("Converting... ","",len(flacs))
-cd(CUETools)
-for count, flac in enumerate(flacs):
-    progress.set_stat(count+1)
-    progress.update()
-    print("\noriginal: %s" % str(flac[0]))
-    print("destination: %s\n" % str(flac[1]))
-    if not exists(dirname(str(flac[1]))):
-        makedirs(dirname(str(flac[1])))
-    cmd("metaflac --export-picture-to=R:\cover \"%s\""  % str(flac[0]))
-    cmd("CUETools.FLACCL.cmd.exe -o \"%s\" --lax -11 \"%s\"" % (str(flac[1]),str(flac[0])))
-    cmd("metaflac --export-tags-to=- \"%s\" | metaflac --import-tags-from=- \"%s\"" % (str(flac[0]), str(flac[1])))
-    if exists("R:\cover"):
-        cmd("metaflac --import-picture-from=\"R:\cover\" \"%s\"" % str(flac[1]))
-        cmd("del R:\cover")
-progress.end()
+from pathlib import Path
+import sys
+
+# Returns the command line arguments, prompting for the directories that are not given.
+def parseArguments(description):
+    import argparse
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-i", "--input", help="Input directory. Prompted for if not given.")
+    parser.add_argument("-o", "--output", help="Output directory. Prompted for if not given.")
+    parser.add_argument("--cue", help="Path to CUETools binary directory. FLACCL and LossyWAV are looked for on PATH if not given.")
+    parser.add_argument("--ffmpeg", help="Path to ffmpeg binary. Looked for on PATH if not given.")
+    parser.add_argument("--ffprobe", help="Path to ffprobe binary. Looked for on PATH if not given.")
+    parser.add_argument("--jobs", help="Number of files to convert in parallel.", type=int, default=1)
+    parser.add_argument("--timing-log", help="Append the timing of every stage to this JSON lines file. Not kept if not given.")
+    return parser
+
+# Converts in_dir into out_dir with profile, showing progress, and prints the timing summary.
+def run(args, profile):
+    from pyprog import ProgressBar
+    from Engine import Engine, Tools, ToolError
+    in_dir = Path(args.input or input("Input Directory: ")).absolute()
+    out_dir = Path(args.output or input("Output Directory: ")).absolute()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # The total grows as files are found.
+    progress = ProgressBar("Converting... ", "", 1)
+    def showProgress(done, total):
+        progress.set_total(max(total, 1))
+        progress.set_stat(done)
+        progress.update()
+    tools = Tools(ffmpeg=args.ffmpeg, ffprobe=args.ffprobe, cue=args.cue)
+    # Every stage is timed and summarised at the end; the timings also go to a JSON lines log if --timing-log is given.
+    engine = Engine(out_dir, profile, tools, jobs=args.jobs, timing_log=args.timing_log, progress=showProgress)
+    try:
+        # Only sources that are new or changed since the last run into out_dir are converted.
+        engine.run(in_dir, layout="files")
+    except ToolError as error:
+        print(error, file=sys.stderr)
+        exit(1)
+    finally:
+        engine.close()
+        progress.end()
+    print("\n".join(engine.summary()))
+
+if __name__ == "__main__":
+    from Engine import Profile
+    parser = parseArguments("Converts FLAC files to FLAC with FLACCL.")
+    parser.add_argument("--passthrough", help="What to do with files that re-encoding would barely shrink. One of off (re-encode them), copy, link (hard-link them where possible).", default="off", choices=("off", "copy", "link"))
+    parser.add_argument("--passthrough-threshold", help="Pass files through when re-encoding saves less than this many percent of their size.", type=float, default=2.0)
+    args = parser.parse_args()
+    run(args, Profile(mode="lossless", passthrough=args.passthrough, passthrough_threshold=args.passthrough_threshold))
@@ -0,0 +1,116 @@
+# Conversion manifest, kept in the root of an output tree.
+# For every output file it records the source it was made from, the source's fingerprint (size and mtime) and the settings used.
+# A rerun converts only sources that are new, changed, or were converted with other settings, and removes outputs whose source is gone.
+# The manifest is saved every few seconds while a run is going, so an interrupted run resumes where it stopped.
+# It also keeps the compression ratios FLACCL achieved on re-encoded tracks, by kind of source, so passthrough (see Engine.py) can judge tracks from the first one on a later run.
+
+from pathlib import Path
+from threading import Lock, get_ident
+from time import monotonic
+import json
+import os
+
+MANIFEST_NAME = ".musicutils_manifest.json"
+MANIFEST_VERSION = 1
+# Compression ratios kept per kind of source; older ones are dropped.
+RATIO_HISTORY = 16
+
+# Returns the fingerprint of a source file. A changed fingerprint means the source has to be converted again.
+def fingerprint(path: Path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+# Safe to share between worker threads. Unless persist is set, it is kept in memory only: nothing is read from or written to the output root.
+class Manifest:
+    def __init__(self, output_root: Path, save_interval=5.0, persist=True):
+        self.output_root = Path(output_root)
+        self.manifest_file = self.output_root / MANIFEST_NAME if persist else None
+        self.save_interval = save_interval
+        self.lock = Lock()
+        self.entries = {}
+        # (vendor, sample rate, bit depth) -> compression ratios of re-encoded tracks, oldest first.
+        self.ratios = {}
+        self.dirty = False
+        self.last_save = monotonic()
+        if self.manifest_file is not None and self.manifest_file.is_file():
+            try:
+                with open(self.manifest_file, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                if saved.get("version") == MANIFEST_VERSION:
+                    self.entries = saved["entries"]
+                    self.ratios = {(kind["vendor"], kind["sample_rate"], kind["bits_per_sample"]): kind["ratios"] for kind in saved.get("compression_ratios", [])}
+            except (OSError, ValueError, KeyError, TypeError):
+                # Without a manifest everything is converted again, which is slow but correct.
+                self.entries = {}
+                self.ratios = {}
+
+    # Manifest keys are output paths relative to the output root, with forward slashes.
+    def key(self, outfile: Path):
+        return Path(outfile).relative_to(self.output_root).as_posix()
+
+    # Returns True if outfile exists and was made from source, unchanged since, with the same settings.
+    def isCurrent(self, source: Path, outfile: Path, settings: dict):
+        with self.lock:
+            entry = self.entries.get(self.key(outfile))
+        if entry is None or not Path(outfile).is_file():
+            return False
+        try:
+            return (entry["source"] == str(Path(source).resolve())
+                    and entry["fingerprint"] == fingerprint(source)
+                    and entry["settings"] == settings)
+        except OSError:
+            return False
+
+    # Records that outfile was made from source with settings. Saves the manifest if the last save is more than save_interval seconds old.
+    def record(self, source: Path, outfile: Path, settings: dict):
+        entry = {"source": str(Path(source).resolve()), "fingerprint": fingerprint(source), "settings": settings}
+        with self.lock:
+            self.entries[self.key(outfile)] = entry
+            self.dirty = True
+            due = monotonic() - self.last_save >= self.save_interval
+        if due:
+            self.save()
+
+    # Returns the compression ratios recorded for a kind of source, a (vendor, sample rate, bit depth) tuple.
+    def compressionRatios(self, kind):
+        with self.lock:
+            return list(self.ratios.get(kind, []))
+
+    # Records the compression ratio FLACCL achieved on a track of a kind of source.
+    def recordCompressionRatio(self, kind, ratio):
+        with self.lock:
+            self.ratios[kind] = (self.ratios.get(kind, []) + [ratio])[-RATIO_HISTORY:]
+            self.dirty = True
+
+    # Deletes every recorded output whose source no longer exists, and drops it from the manifest. Returns the deleted outputs.
+    def prune(self):
+        with self.lock:
+            gone = [key for key, entry in self.entries.items() if not Path(entry["source"]).exists()]
+            for key in gone:
+                del self.entries[key]
+            if gone:
+                self.dirty = True
+        for key in gone:
+            outfile = self.output_root / key
+            if outfile.is_file():
+                outfile.unlink()
+        return [self.output_root / key for key in gone]
+
+    # Writes the manifest to disk, if anything changed. The file is replaced atomically, so a crash never leaves a half-written manifest.
+    def save(self):
+        with self.lock:
+            if self.manifest_file is None or not self.dirty:
+                return
+            self.output_root.mkdir(parents=True, exist_ok=True)
+            # A name of its own, since other runs (and threads) may be saving the same file.
+            temp_file = self.manifest_file.with_name(f"{self.manifest_file.name}.{os.getpid()}.{get_ident()}.tmp")
+            try:
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    ratios = [{"vendor": vendor, "sample_rate": sample_rate, "bits_per_sample": bits_per_sample, "ratios": ratios} for (vendor, sample_rate, bits_per_sample), ratios in self.ratios.items()]
+                    json.dump({"version": MANIFEST_VERSION, "entries": self.entries, "compression_ratios": ratios}, f)
+                os.replace(temp_file, self.manifest_file)
+            except BaseException:
+                temp_file.unlink(missing_ok=True)
+                raise
+            self.dirty = False
+            self.last_save = monotonic()
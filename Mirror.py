@@ -0,0 +1,128 @@
+# Mirroring of asset files (cover art, scans, logs, cue sheets) into an output tree.
+# Files are mirrored on a pool of threads. Where the filesystem allows, a file is reflinked (a copy-on-write clone, which costs no time or space) or, failing that, hard-linked; otherwise its bytes are copied.
+# A file whose copy already has the same size and mtime (within MTIME_WINDOW) is skipped, so a rerun only touches what changed. Files that are made anew every run (such as pictures from the artwork store) can be compared by their contents instead.
+# Copies are written under a temporary name and renamed into place, so an interrupted copy is never mistaken for a finished one, and an old hard link is replaced instead of written through.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock, get_ident
+import filecmp
+import os
+import shutil
+import sys
+
+from Timing import StageTimer
+
+# Linux ioctl that clones the extents of one file into another on the same filesystem (Btrfs, XFS, bcachefs, ...).
+FICLONE = 0x40049409
+# Largest difference, in nanoseconds, between two mtimes that still count as the same, like rsync's --modify-window. FAT32 keeps mtimes to 2 s, exFAT to 10 ms.
+MTIME_WINDOW = 2_000_000_000
+# How files are mirrored: "auto" tries a reflink, then a hard link, then a copy; "reflink" never hard-links; "copy" always copies the bytes.
+MODES = ("auto", "reflink", "copy")
+
+# Tries to reflink source into dest, a new file. Returns True if it worked.
+def reflink(source: Path, dest: Path):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            return False
+
+# Mirrors source to dest, as set by mode (see MODES). Returns how: "unchanged" (dest was already up to date), "reflink", "hardlink" or "copy".
+# dest is up to date if it has the same size and mtime (within MTIME_WINDOW) as source or, with compare_contents, the same bytes.
+def mirrorFile(source: Path, dest: Path, mode="auto", compare_contents=False):
+    stat = os.stat(source)
+    try:
+        existing = os.stat(dest)
+        if existing.st_size == stat.st_size and (abs(existing.st_mtime_ns - stat.st_mtime_ns) <= MTIME_WINDOW or compare_contents and filecmp.cmp(source, dest, shallow=False)):
+            return "unchanged"
+    except FileNotFoundError:
+        pass
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = dest.with_name(f"{dest.name}.{os.getpid()}.{get_ident()}.tmp")
+    try:
+        method = None
+        if mode != "copy" and reflink(source, temp_file):
+            # Same mtime as the source, so the next run sees it is up to date.
+            shutil.copystat(source, temp_file)
+            method = "reflink"
+        elif mode == "auto":
+            try:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                os.link(source, temp_file)
+                method = "hardlink"
+            except OSError:
+                # Another filesystem, or one without hard links.
+                pass
+        if method is None:
+            shutil.copy2(source, temp_file)
+            method = "copy"
+        os.replace(temp_file, dest)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return method
+
+# Mirrors files on a pool of jobs threads. Every file is timed as one run of stage. Safe to submit to from several threads.
+class Mirror:
+    def __init__(self, jobs=4, mode="auto", timer: StageTimer = None, stage="asset"):
+        self.mode = mode
+        self.timer = timer if timer is not None else StageTimer()
+        self.stage = stage
+        self.pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.lock = Lock()
+        self.pending = []
+        # Files and bytes mirrored, by how.
+        self.counts = {}
+        self.sizes = {}
+
+    # Mirrors source to dest in the background (see mirrorFile). Returns a future for how it was done.
+    def submit(self, source, dest, compare_contents=False):
+        return self.run(self.mirror, Path(source), Path(dest), compare_contents)
+
+    # Runs function(*args) on the pool, for work that ends in mirroring a file (such as making the file first). wait() waits for it too. Returns a future for its result.
+    def run(self, function, *args):
+        future = self.pool.submit(function, *args)
+        with self.lock:
+            self.pending.append(future)
+        return future
+
+    def mirror(self, source: Path, dest: Path, compare_contents):
+        size = os.stat(source).st_size
+        with self.timer.time(self.stage, track=str(source), bytes_in=size) as fields:
+            method = mirrorFile(source, dest, self.mode, compare_contents)
+            fields["method"] = method
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+            self.sizes[method] = self.sizes.get(method, 0) + size
+        return method
+
+    # Waits for every file submitted so far, re-raising the first failure.
+    def wait(self):
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            for future in pending:
+                future.result()
+
+    # Waits for every file, and stops the threads.
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    # Returns how the files were mirrored, as a line of text for the end of the run, or no lines if there were none.
+    def summary(self, unit="files"):
+        with self.lock:
+            counts, sizes = dict(self.counts), dict(self.sizes)
+        if not counts:
+            return []
+        names = {"copy": "copied", "reflink": "reflinked", "hardlink": "hard-linked", "unchanged": "already up to date"}
+        parts = [f"{counts[method]} {names[method]} ({sizes[method] / 1e6:.1f} MB)" for method in names if method in counts]
+        return [f"{sum(counts.values())} {unit}: " + ", ".join(parts)]
@@ -1,33 +1,14 @@
-from pathlib import Path, PurePath
-from pyprog import ProgressBar
-from os import system as cmd
-from os import chdir as cd
-from os import makedirs
-from os.path import exists, dirname
+# Converts every FLAC file under a directory to lossy FLAC with LossyWAV and FLACCL, keeping tags and embedded cover art.
+# Usage: -i <input directory> -o <output directory> --quality <I/E/S/P> --cue <path to CUETools> --ffmpeg <path to ffmpeg> --ffprobe <path to ffprobe> --jobs <N> --timing-log <path to JSON lines file>
+# Input and output directories and the quality are prompted for if not given. Tools that are not given are looked for on PATH.
+# The conversion itself is done by Engine.py; see Normalize.py for a script with every option.
 
-FFmpeg = PurePath(r"C:\ProgramData\chocolatey\bin\ffmpeg.exe")
-CUETools = PurePath(r"S:\CUETools_2.2.2")
-metaflac = PurePath(r"C:\ProgramData\chocolatey\bin\metaflac.exe")
-in_dir = Path(input("Input Directory: "))
-out_dir = Path(input("Output Directory: "))
-quality = input("Quality (one of I, E, S, P): ")[0].upper()
-in_flacs = tuple(in_dir.glob("**/*.flac"))
-out_flacs = tuple([Path(str(out_dir)+"\\"+str(flac.relative_to(in_dir))) for flac in in_flacs])
-assert len(in_flacs) == len(out_flacs)
-flacs = tuple(zip(in_flacs, out_flacs))
-progress = ProgressBar("Converting... ","",len(flacs))
-cd(CUETools)
-for count, flac in enumerate(flacs):
-    progress.set_stat(count+1)
-    progress.update()
-    print("\noriginal: %s" % str(flac[0]))
-    print("destination: %s\n" % str(flac[1]))
-    if not exists(dirname(str(flac[1]))):
-        makedirs(dirname(str(flac[1])))
-    cmd("metaflac --export-picture-to=R:\cover \"%s\""  % str(flac[0]))
-    cmd("ffmpeg -i \"%s\" -c:a pcm_s24le -f wav pipe:1 | CUETools.LossyWAV.exe - -%s --stdout | CUETools.FLACCL.cmd.exe -o \"%s\" --lax -11 -" % (str(flac[0]), quality, str(flac[1])))
-    cmd("metaflac --export-tags-to=- \"%s\" | metaflac --import-tags-from=- \"%s\"" % (str(flac[0]), str(flac[1])))
-    if exists("R:\cover"):
-        cmd("metaflac --import-picture-from=\"R:\cover\" \"%s\"" % str(flac[1]))
-        cmd("del R:\cover")
-progress.end()
\ No newline at end of file
+from GPUalbum import parseArguments, run
+
+if __name__ == "__main__":
+    from Engine import Profile
+    parser = parseArguments("Converts FLAC files to lossy FLAC with LossyWAV and FLACCL.")
+    parser.add_argument("--quality", help="LossyWAV quality. One of I, E, S, P. Prompted for if not given.")
+    args = parser.parse_args()
+    quality = (args.quality or input("Quality (one of I, E, S, P): "))[0].upper()
+    run(args, Profile(mode=quality))
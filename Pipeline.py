@@ -0,0 +1,146 @@
+# Streaming subprocess pipelines.
+# Each stage's stdout is connected straight to the next stage's stdin through an OS pipe, so audio flows from decoder to encoder without touching the disk.
+# Only in-process stages (such as the NumPy resampler) see the data in Python.
+# OS pipes are bounded, so a slow stage (usually the encoder) holds back the ones before it instead of letting data pile up in memory.
+# Every stage's exit status is checked, and the stderr of every failing stage ends up in the raised error.
+
+from subprocess import Popen, PIPE, DEVNULL, CalledProcessError
+from threading import Thread
+from time import perf_counter
+from traceback import format_exception_only
+import os
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where pipe sizes cannot be changed anyway.
+    fcntl = None
+
+# How much of the end of each stage's stderr is kept for error messages.
+STDERR_TAIL = 4096
+# Size of the pipes between stages, where the OS allows setting it. Bigger pipes mean fewer context switches between stages.
+PIPE_SIZE = 1 << 20
+
+# Raised when one or more stages of a pipeline exit with a non-zero status.
+# returncode, cmd and stderr describe the failure that caused the others; failures lists (command, returncode, stderr) for every failing stage, most downstream first.
+# A stage that fails while a later stage also failed is taken to be a victim of it: once a stage dies, the one before it gets a broken pipe, which it may report in any way
+# (killed by SIGPIPE, BrokenPipeError, or like ffmpeg, which ignores SIGPIPE, an ordinary exit status; Windows has no SIGPIPE at all). So the most downstream failure comes first.
+class PipelineError(CalledProcessError):
+    def __init__(self, failures):
+        command, returncode, stderr = failures[0]
+        super().__init__(returncode, command, stderr=stderr)
+        self.failures = failures
+
+    def __str__(self):
+        stages = "; ".join(f"{command[0]} exited with status {returncode}: {stderr.strip()[-400:]}" for command, returncode, stderr in self.failures)
+        return f"Pipeline failed. {stages}"
+
+# Enlarges a pipe (a file object), if the OS supports it.
+def setPipeSize(pipe, size=PIPE_SIZE):
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        # Over the system limit; the default size still works.
+        pass
+
+# Reads a stage's stderr until it closes, keeping only the last STDERR_TAIL bytes.
+def drainStderr(stream, tail: bytearray):
+    for chunk in iter(lambda: stream.read(STDERR_TAIL), b""):
+        tail += chunk
+        del tail[:-STDERR_TAIL]
+    stream.close()
+
+# Runs an in-process stage in its own thread. The stage owns both ends: they are closed when it returns, so the stages around it see end-of-file or a broken pipe.
+def runInProcess(stage, reader, writer, errors: list):
+    try:
+        stage(reader, writer)
+    except BaseException as error:
+        errors.append(error)
+    finally:
+        for stream in (writer, reader):
+            try:
+                stream.close()
+            except OSError:
+                # Flushing into a pipe whose reader died; the failure shows up in that stage.
+                pass
+
+# Closes what a stage was reading from, once it has been handed over: a file object or a raw descriptor.
+def closeInput(stream):
+    if isinstance(stream, int):
+        os.close(stream)
+    else:
+        stream.close()
+
+# Runs stages as a pipeline: stage 1 | stage 2 | ... | stage N.
+# A stage is either a command (a list of arguments) or an in-process stage: a callable stage(reader, writer) that reads its input from one binary file object and writes its output to another.
+# In-process stages run in threads of their own, and can only sit between two commands.
+# The first stage reads from stdin and the last one writes to stdout (both default to nothing; the last stage normally writes its output file itself).
+# Returns once every stage has finished, with a list of (command or [name], wall time in seconds) for every stage, from its start until it exited. Raises PipelineError if any stage failed.
+def runPipeline(stages, stdin=DEVNULL, stdout=DEVNULL):
+    if callable(stages[0]) or callable(stages[-1]):
+        raise ValueError("In-process stages must sit between two commands.")
+    running = [] # (command or name, Popen or Thread, stderr tail or list of errors, drain thread or None, start time)
+    previous = stdin
+    try:
+        for index, stage in enumerate(stages):
+            last = index == len(stages) - 1
+            if callable(stage):
+                if isinstance(previous, int):
+                    # The read end of the pipe from an in-process stage right before this one.
+                    previous = open(previous, "rb")
+                read_end, write_end = os.pipe()
+                writer = open(write_end, "wb")
+                setPipeSize(writer)
+                errors = []
+                thread = Thread(target=runInProcess, args=(stage, previous, writer, errors), daemon=True)
+                thread.start()
+                running.append(([getattr(stage, "name", getattr(stage, "__name__", "stage"))], thread, errors, None, perf_counter()))
+                previous = read_end
+                continue
+            process = Popen(stage, stdin=previous, stdout=stdout if last else PIPE, stderr=PIPE)
+            # Only the next stage may hold the read end of a pipe, so it sees end-of-file, and the writer sees a broken pipe if the reader dies.
+            if index > 0:
+                closeInput(previous)
+            if not last:
+                setPipeSize(process.stdout)
+                previous = process.stdout
+            tail = bytearray()
+            drain = Thread(target=drainStderr, args=(process.stderr, tail), daemon=True)
+            drain.start()
+            running.append((stage, process, tail, drain, perf_counter()))
+    except BaseException:
+        # A stage could not be started: stop the ones that were. In-process stages stop on their own once their pipes are gone.
+        if index > 0:
+            try:
+                closeInput(previous)
+            except OSError:
+                pass
+        for _, worker, _, _, _ in running:
+            if isinstance(worker, Popen):
+                worker.kill()
+        for _, worker, _, _, _ in running:
+            if isinstance(worker, Popen):
+                worker.wait()
+            else:
+                worker.join()
+        raise
+    failures = []
+    # Stages are waited for in pipeline order, which is also the order they finish in, since each one runs until the one before it closes its output.
+    timings = []
+    for command, worker, output, drain, started in running:
+        if isinstance(worker, Popen):
+            returncode = worker.wait()
+            timings.append((command, perf_counter() - started))
+            drain.join()
+            if returncode != 0:
+                failures.append((command, returncode, output.decode(errors="replace")))
+        else:
+            worker.join()
+            timings.append((command, perf_counter() - started))
+            if output:
+                error = output[0]
+                failures.append((command, 1, "".join(format_exception_only(type(error), error))))
+    if failures:
+        raise PipelineError(failures[::-1])
+    return timings
@@ -0,0 +1,114 @@
+# Single-pass probing of audio files, with a persistent on-disk cache.
+# FLAC files are probed natively through FlacMeta (stream info and tags from the same few KB of header); anything else takes one ffprobe call that returns both at once.
+# Results are cached in a JSON file keyed by the resolved path, and are reused as long as the file's size and mtime have not changed.
+
+from pathlib import Path
+from subprocess import check_output, DEVNULL
+from threading import Lock, get_ident
+import json
+import os
+
+from FlacMeta import readFlac, FlacError
+
+# Bump this whenever the shape of a probe result changes, so that old caches are ignored.
+# 2: total_samples of ffprobed files is in samples, not in the stream's time base.
+CACHE_VERSION = 2
+
+# Probes a file without looking at the cache. Returns a dict with at least "sample_rate", "channels", "bits_per_sample", "total_samples", "vendor", "tags" and "pictures".
+def probeFile(path: Path, ffprobe_path=None):
+    if path.suffix == ".flac":
+        try:
+            # Picture data is not read, so only where each picture lives ends up in the cache.
+            return readFlac(path)
+        except FlacError:
+            if ffprobe_path is None:
+                raise
+    return probeWithFFprobe(path, ffprobe_path)
+
+# Probes any file ffprobe can read, in a single ffprobe launch. ffprobe_path may also be a function returning the path, so ffprobe is only looked for once it is needed.
+def probeWithFFprobe(path: Path, ffprobe_path):
+    if callable(ffprobe_path):
+        ffprobe_path = ffprobe_path()
+    output = json.loads(check_output([str(ffprobe_path), "-v", "error", "-select_streams", "a:0",
+                                      "-show_entries", "stream=sample_rate,channels,bits_per_raw_sample,duration_ts,time_base:stream_tags:format_tags",
+                                      "-of", "json", str(path)], stderr=DEVNULL))
+    stream = output["streams"][0]
+    tags = {}
+    # Format tags (containers) and stream tags (e.g. Ogg) are merged, with stream tags winning.
+    for source in (output.get("format", {}).get("tags", {}), stream.get("tags", {})):
+        for name, value in source.items():
+            tags[name.upper()] = [value]
+    bits_per_sample = stream.get("bits_per_raw_sample", "N/A")
+    sample_rate = int(stream["sample_rate"])
+    return {
+        "sample_rate": sample_rate,
+        "channels": int(stream.get("channels", 2)),
+        # Default to 24 bits in the worst case (lossy sources have no bit depth).
+        "bits_per_sample": int(bits_per_sample) if bits_per_sample.isdigit() else 24,
+        "total_samples": totalSamples(stream, sample_rate),
+        "vendor": tags.get("ENCODER", [""])[0],
+        "tags": tags,
+        "pictures": [],
+    }
+
+# Returns the length of an ffprobe stream in samples, or 0 if unknown. duration_ts counts ticks of the stream's time base, which is only 1/sample_rate for some formats (MP3's is 1/14112000).
+def totalSamples(stream, sample_rate):
+    numerator, _, denominator = str(stream.get("time_base", "")).partition("/")
+    duration = str(stream.get("duration_ts", ""))
+    if not (duration.isdigit() and numerator.isdigit() and denominator.isdigit()) or int(denominator) == 0:
+        return 0
+    return round(int(duration) * int(numerator) * sample_rate / int(denominator))
+
+# Returns the first value of a tag in a probe result, or default if the tag is missing.
+def tag(info, name, default=""):
+    return info["tags"].get(name.upper(), [default])[0]
+
+# A persistent cache of probe results. Safe to share between worker threads.
+class ProbeCache:
+    def __init__(self, cache_file: Path = None, ffprobe_path=None):
+        self.cache_file = cache_file
+        self.ffprobe_path = ffprobe_path
+        self.lock = Lock()
+        self.entries = {}
+        self.dirty = False
+        if cache_file is not None and cache_file.is_file():
+            try:
+                with open(cache_file, "r", encoding="utf-8") as f:
+                    cached = json.load(f)
+                if cached.get("version") == CACHE_VERSION:
+                    self.entries = cached["entries"]
+            except (OSError, ValueError, KeyError):
+                # A damaged cache is only a lost speedup; start over.
+                self.entries = {}
+
+    # Returns the probe result for path, probing the file only if it is new or has changed since it was cached.
+    def probe(self, path: Path):
+        stat = os.stat(path)
+        key = str(Path(path).resolve())
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["info"]
+        info = probeFile(Path(path), self.ffprobe_path)
+        with self.lock:
+            self.entries[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "info": info}
+            self.dirty = True
+        return info
+
+    # Writes the cache back to disk, if anything changed. The file is replaced atomically, so an interrupted save never corrupts it.
+    def save(self):
+        if self.cache_file is None:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            # A name of its own, since other runs (and threads) may be saving the same file.
+            temp_file = self.cache_file.with_name(f"{self.cache_file.name}.{os.getpid()}.{get_ident()}.tmp")
+            try:
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    json.dump({"version": CACHE_VERSION, "entries": self.entries}, f)
+                os.replace(temp_file, self.cache_file)
+            except BaseException:
+                temp_file.unlink(missing_ok=True)
+                raise
+            self.dirty = False
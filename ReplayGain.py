@@ -0,0 +1,165 @@
+# ReplayGain 2.0 analysis (ITU-R BS.1770 loudness, -18 LUFS reference), computed from PCM that is already flowing through the conversion pipeline.
+# The K-weighting filter is applied as a long FIR (its impulse response, truncated far below the noise floor) with FFT overlap-add, so whole blocks are filtered at once in NumPy.
+# Loudness is measured over 400 ms blocks every 100 ms, with the absolute (-70 LUFS) and relative (-10 LU) gates. Album loudness gates the blocks of all tracks together.
+
+from functools import lru_cache
+from subprocess import Popen, PIPE, DEVNULL
+import numpy as np
+
+from AudioIO import BLOCK_FRAMES, StreamReader, WavReader, readWavHeader, fromPCM
+
+# ReplayGain 2.0 target loudness, in LUFS.
+REFERENCE_LOUDNESS = -18.0
+# Returns the two K-weighting biquads (high shelf, then high pass) for a sample rate, as (b, a) pairs. The same design as libebur128, valid at any rate.
+def kWeighting(rate):
+    K = np.tan(np.pi * 1681.974450955533 / rate)
+    Q = 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    shelf = (np.array([Vh + Vb * K / Q + K * K, 2 * (K * K - Vh), Vh - Vb * K / Q + K * K]) / a0,
+             np.array([1, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]))
+    K = np.tan(np.pi * 38.13547087602444 / rate)
+    Q = 0.5003270373238773
+    a0 = 1 + K / Q + K * K
+    highpass = (np.array([1.0, -2.0, 1.0]),
+                np.array([1, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]))
+    return shelf, highpass
+
+# Returns the K-weighting impulse response for a sample rate, long enough (about a third of a second) that the truncated tail is far below 24-bit resolution.
+@lru_cache(maxsize=None)
+def impulseResponse(rate):
+    length = 1 << max(12, int(np.ceil(np.log2(rate / 3))))
+    # Sample the frequency response on a grid four times longer than the result, so time aliasing is negligible.
+    grid = 4 * length
+    response = np.ones(grid // 2 + 1, dtype=complex)
+    for b, a in kWeighting(rate):
+        response *= np.fft.rfft(b, grid) / np.fft.rfft(a, grid)
+    return np.fft.irfft(response, grid)[:length]
+
+# Per-channel weights of BS.1770: the LFE channel is left out and surround channels count 1.41 times.
+def channelWeights(channels):
+    if channels == 5:
+        return np.array([1.0, 1.0, 1.0, 1.41, 1.41])
+    if channels == 6:
+        return np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    return np.ones(channels)
+
+# Measures one track. Feed it float samples (frames x channels, full scale 1.0), then call finish().
+class LoudnessMeter:
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        self.weights = channelWeights(channels)
+        self.impulse = impulseResponse(rate)
+        # Filter output that spills over into the next block.
+        self.tail = np.zeros((len(self.impulse) - 1, channels))
+        self.segment_length = rate // 10
+        # Weighted energy of every complete 100 ms segment, and of the partial segment being filled.
+        self.segments = []
+        self.partial = 0.0
+        self.partial_length = 0
+        self.peak = 0.0
+
+    def feed(self, samples):
+        if len(samples) == 0:
+            return
+        self.peak = max(self.peak, float(np.abs(samples).max()))
+        size = 1 << int(np.ceil(np.log2(len(samples) + len(self.impulse) - 1)))
+        filtered = np.fft.irfft(np.fft.rfft(samples, size, axis=0) * np.fft.rfft(self.impulse, size)[:, None], size, axis=0)
+        filtered = filtered[:len(samples) + len(self.impulse) - 1]
+        filtered[:len(self.tail)] += self.tail
+        self.tail = filtered[len(samples):].copy()
+        energy = (filtered[:len(samples)] ** 2) @ self.weights
+        # Complete the partial segment, then cut the rest into 100 ms segments.
+        position = min(len(energy), self.segment_length - self.partial_length)
+        self.partial += energy[:position].sum()
+        self.partial_length += position
+        if self.partial_length == self.segment_length:
+            self.segments.append(self.partial)
+            whole = (len(energy) - position) // self.segment_length * self.segment_length
+            self.segments.extend(energy[position:position + whole].reshape(-1, self.segment_length).sum(axis=1))
+            self.partial = energy[position + whole:].sum()
+            self.partial_length = len(energy) - position - whole
+
+    # Returns the track's result: its sample peak, and the mean power of every 400 ms block.
+    def finish(self):
+        segments = np.array(self.segments)
+        if len(segments) >= 4:
+            blocks = (segments[:-3] + segments[1:-2] + segments[2:-1] + segments[3:]) / (4 * self.segment_length)
+        else:
+            # Shorter than one block: measure the whole track as a single block.
+            length = len(segments) * self.segment_length + self.partial_length
+            blocks = np.array([(segments.sum() + self.partial) / length]) if length else np.zeros(0)
+        return {"peak": self.peak, "blocks": blocks}
+
+# Gated loudness, in LUFS, of a set of 400 ms block powers.
+def gatedLoudness(blocks):
+    blocks = blocks[blocks > 0]
+    loudness = -0.691 + 10 * np.log10(blocks)
+    blocks = blocks[loudness > -70]
+    if len(blocks) == 0:
+        return -70.0
+    relative_gate = -0.691 + 10 * np.log10(blocks.mean()) - 10
+    loudness = -0.691 + 10 * np.log10(blocks)
+    return float(-0.691 + 10 * np.log10(blocks[loudness > relative_gate].mean()))
+
+# Returns (gain in dB, peak) for one track result.
+def trackGain(result):
+    return REFERENCE_LOUDNESS - gatedLoudness(result["blocks"]), result["peak"]
+
+# Returns (gain in dB, peak) for an album, from the results of all its tracks.
+def albumGain(results):
+    return REFERENCE_LOUDNESS - gatedLoudness(np.concatenate([result["blocks"] for result in results])), max(result["peak"] for result in results)
+
+# Returns the ReplayGain tags for a gain and peak, under the given prefix ("TRACK" or "ALBUM").
+def replayGainTags(prefix, gain, peak):
+    return {f"REPLAYGAIN_{prefix}_GAIN": f"{gain:+.2f} dB", f"REPLAYGAIN_{prefix}_PEAK": f"{peak:.6f}"}
+
+# Measures a WAV stream. If writer is given, every byte read is passed on to it unchanged.
+def analyzeWav(reader, writer=None):
+    header, channels, rate, bits, is_float, data_size = readWavHeader(reader)
+    if writer is not None:
+        writer.write(header)
+    meter = LoudnessMeter(rate, channels)
+    blocks = StreamReader(reader, channels * bits // 8, BLOCK_FRAMES, data_size)
+    for block in blocks:
+        if writer is not None:
+            writer.write(block)
+        meter.feed(fromPCM(block, channels, bits, is_float))
+    if writer is not None:
+        # A truncated last frame and chunks after the data chunk are passed on, but not measured.
+        writer.write(blocks.tail)
+        for data in iter(lambda: reader.read(BLOCK_FRAMES), b""):
+            writer.write(data)
+    return meter.finish()
+
+# Measures a WAV file, a block at a time through a memory mapping, so memory use does not grow with the length of the file.
+def analyzeWavFile(path):
+    with WavReader(path) as wav:
+        meter = LoudnessMeter(wav.rate, wav.channels)
+        for block in wav.blocks(BLOCK_FRAMES):
+            meter.feed(wav.toFloat(block))
+        return meter.finish()
+
+# A pipeline stage (see Pipeline.runPipeline) that passes a WAV stream through unchanged and measures it on the way. The result is handed to done(result) once the stream ends.
+class AnalyzeStage:
+    name = "replaygain analyzer"
+
+    def __init__(self, done):
+        self.done = done
+
+    def __call__(self, reader, writer):
+        self.done(analyzeWav(reader, writer))
+
+# Measures an audio file by decoding it with ffmpeg. Used for tracks that were not converted in this run.
+def analyzeFile(ffmpeg_path, path):
+    decoder = Popen([str(ffmpeg_path), "-v", "error", "-i", str(path), "-map", "0:a:0", "-map_metadata", "-1", "-c:a", "pcm_s32le", "-f", "wav", "-"], stdout=PIPE, stderr=DEVNULL)
+    try:
+        result = analyzeWav(decoder.stdout)
+    finally:
+        decoder.stdout.close()
+        returncode = decoder.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {path} for ReplayGain analysis.")
+    return result
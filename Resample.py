@@ -0,0 +1,180 @@
+# In-process polyphase resampler, built on NumPy.
+# Resamples by any rational ratio L/M with a Kaiser-windowed sinc filter, split into L phases so that only the output samples are ever computed.
+# Integer ratios (88.2k -> 44.1k, 96k -> 48k, 192k -> 48k) have a single phase and are the cheap, common case.
+# Audio is processed in fixed-size blocks, so memory use does not depend on the length of the track.
+# Usage as a benchmark against ReSampler: python Resample.py <input.wav> <output.wav> <rate> [--threads N]
+
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+import numpy as np
+
+from AudioIO import StreamReader, WavReader, WavWriter, toPCM, wavHeader
+
+# Zero crossings of the sinc on each side of the centre, at the lower of the two rates. More means a steeper filter and more work.
+ZERO_CROSSINGS = 32
+# Kaiser window beta. 9 gives roughly 90 dB of stopband attenuation.
+KAISER_BETA = 9.0
+# Passband edge, as a fraction of the lower Nyquist frequency.
+ROLLOFF = 0.95
+# Input frames read per block.
+BLOCK_FRAMES = 1 << 15
+# Longest shortfall, in seconds of output, that is padded with silence when the input is shorter than total_frames said.
+MAX_PADDING = 1.0
+# Upper bound on output frames times filter taps computed at once, which bounds the size of the temporary arrays.
+MAX_WORK = 1 << 20
+
+# Designs the prototype lowpass filter for resampling by up/down, split into its up phases. Returns (phases, delay): phases[p] holds the taps of phase p in reverse order, ready to be applied to a window of input samples.
+def designFilter(up, down):
+    factor = max(up, down)
+    length = 2 * ZERO_CROSSINGS * factor + 1
+    delay = ZERO_CROSSINGS * factor
+    cutoff = ROLLOFF / factor
+    n = np.arange(length) - delay
+    # Gain of up makes up for the zeros stuffed in between input samples.
+    taps = up * cutoff * np.sinc(cutoff * n) * np.kaiser(length, KAISER_BETA)
+    taps_per_phase = -(-length // up)
+    taps = np.concatenate([taps, np.zeros(taps_per_phase * up - length)])
+    phases = taps.reshape(taps_per_phase, up).T[:, ::-1].copy()
+    return phases, delay
+
+# A streaming resampler for interleaved float64 audio (frames x channels).
+class PolyphaseResampler:
+    def __init__(self, in_rate, out_rate, channels, threads=1):
+        divisor = gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.channels = channels
+        self.phases, self.delay = designFilter(self.up, self.down)
+        self.taps = self.phases.shape[1]
+        # Input history, starting at absolute input frame self.base. The filter sees zeros before the first frame.
+        self.buffer = np.zeros((self.taps - 1, channels))
+        self.base = -(self.taps - 1)
+        self.frames_in = 0
+        # Next output frame to compute.
+        self.next_out = 0
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 and channels > 1 else None
+
+    # Returns the number of output frames for frames_in input frames.
+    def outputLength(self, frames_in):
+        return -(-frames_in * self.up // self.down)
+
+    # Input frame that the newest tap of output frame m lands on.
+    def lastInput(self, m):
+        return (m * self.down + self.delay) // self.up
+
+    # Computes output frames [start, stop) from the buffered input.
+    def compute(self, start, stop):
+        out = np.empty((stop - start, self.channels))
+        step = max(1, MAX_WORK // self.taps)
+        for first in range(start, stop, step):
+            m = np.arange(first, min(first + step, stop))
+            position = m * self.down + self.delay
+            newest = position // self.up - self.base
+            phases = self.phases[position % self.up]
+            windows = np.lib.stride_tricks.sliding_window_view(self.buffer, self.taps, axis=0)[newest - (self.taps - 1)]
+            def channel(c):
+                out[first - start:first - start + len(m), c] = np.einsum("ij,ij->i", windows[:, c, :], phases)
+            if self.pool is None:
+                for c in range(self.channels):
+                    channel(c)
+            else:
+                list(self.pool.map(channel, range(self.channels)))
+        return out
+
+    # Feeds a block of input frames. Returns the output frames that can be computed so far.
+    def process(self, block):
+        self.buffer = np.concatenate([self.buffer, block])
+        self.frames_in += len(block)
+        available = self.base + len(self.buffer) - 1
+        # Every output frame whose newest tap is already buffered can be computed.
+        stop = -(-((available + 1) * self.up - self.delay) // self.down)
+        stop = min(stop, self.outputLength(self.frames_in))
+        if stop <= self.next_out:
+            return np.empty((0, self.channels))
+        out = self.compute(self.next_out, stop)
+        self.next_out = stop
+        self.trim()
+        return out
+
+    # Drops buffered input that no future output frame needs.
+    def trim(self):
+        keep_from = self.lastInput(self.next_out) - (self.taps - 1)
+        drop = keep_from - self.base
+        if drop > 0:
+            self.buffer = self.buffer[drop:]
+            self.base = keep_from
+
+    # Returns the remaining output frames, treating everything after the last input frame as silence.
+    def flush(self):
+        total = self.outputLength(self.frames_in)
+        if total <= self.next_out:
+            return np.empty((0, self.channels))
+        needed = self.lastInput(total - 1) - (self.base + len(self.buffer) - 1)
+        if needed > 0:
+            self.buffer = np.concatenate([self.buffer, np.zeros((needed, self.channels))])
+        out = self.compute(self.next_out, total)
+        self.next_out = total
+        if self.pool is not None:
+            self.pool.shutdown()
+        return out
+
+# Resamples a stream. Reads raw interleaved s32le frames from reader and writes a WAV of the given bit depth to writer.
+# If total_frames (the input length) is known, the WAV header carries the exact output size. Pass it only when it is exact (as in FLAC's STREAMINFO); otherwise the sizes are left unknown.
+def resampleStream(reader, writer, channels, in_rate, out_rate, bits, total_frames=None, threads=1):
+    resampler = PolyphaseResampler(in_rate, out_rate, channels, threads)
+    expected = resampler.outputLength(total_frames) if total_frames else None
+    writer.write(wavHeader(out_rate, channels, bits, expected))
+    written = 0
+    # Writes output frames, holding the stream to the length promised in the header.
+    def write(frames):
+        nonlocal written
+        if expected is not None:
+            frames = frames[:expected - written]
+        writer.write(toPCM(frames, bits))
+        written += len(frames)
+    # A truncated last frame cannot be resampled; the decoder never produces one.
+    for block in StreamReader(reader, 4 * channels, BLOCK_FRAMES):
+        write(resampler.process(np.frombuffer(block, "<i4").reshape(-1, channels) / 2147483648.0))
+    write(resampler.flush())
+    if expected is not None and written < expected <= written + MAX_PADDING * out_rate:
+        # The source was a little shorter than its header said: pad it to the promised length.
+        while written < expected:
+            write(np.zeros((min(BLOCK_FRAMES, expected - written), channels)))
+    # A longer shortfall is left short rather than padded; the encoder is told to ignore the chunk sizes.
+
+# A pipeline stage (see Pipeline.runPipeline) that resamples the decoder's raw s32le output to a WAV for the next stage.
+class ResampleStage:
+    name = "numpy resampler"
+
+    def __init__(self, channels, in_rate, out_rate, bits, total_frames=None, threads=1):
+        self.channels = channels
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.bits = bits
+        self.total_frames = total_frames
+        self.threads = threads
+
+    def __call__(self, reader, writer):
+        resampleStream(reader, writer, self.channels, self.in_rate, self.out_rate, self.bits, self.total_frames, self.threads)
+
+if __name__ == "__main__":
+    import argparse
+    from time import perf_counter
+    parser = argparse.ArgumentParser(description="Resamples a PCM WAV file with the built-in polyphase resampler, and reports how long it took.")
+    parser.add_argument("input", help="Input WAV file (16, 24 or 32-bit PCM, or float).")
+    parser.add_argument("output", help="Output WAV file.")
+    parser.add_argument("rate", help="Target sample rate in Hz.", type=int)
+    parser.add_argument("--bits", help="Output bit depth. Defaults to the input's, or 24 for float input.", type=int)
+    parser.add_argument("--threads", help="Threads to spread channels over.", type=int, default=1)
+    args = parser.parse_args()
+    start = perf_counter()
+    # Both files are memory-mapped and processed a block at a time, so memory use does not depend on their length.
+    with WavReader(args.input) as wav:
+        channels, rate, frames = wav.channels, wav.rate, wav.frames
+        resampler = PolyphaseResampler(rate, args.rate, channels, args.threads)
+        with WavWriter(args.output, args.rate, channels, args.bits or (24 if wav.is_float else wav.bits), resampler.outputLength(frames)) as out:
+            for block in wav.blocks(BLOCK_FRAMES):
+                out.write(resampler.process(wav.toFloat(block)))
+            out.write(resampler.flush())
+    elapsed = perf_counter() - start
+    print(f"{frames / rate:.1f} s of audio in {elapsed:.2f} s ({frames / rate / elapsed:.1f}x realtime)")
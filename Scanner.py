@@ -0,0 +1,97 @@
+# Streaming scanner for a library tree.
+# Every directory is listed exactly once, with os.scandir, and turned into a plan entry as soon as it has been listed. The converter starts on the first entry while the rest of the tree is still being scanned.
+# A plan entry is a dict:
+#   "kind": "album" (every FLAC file has the same album tag), "singles" (an artist directory of singles, next to albums), "single" (a directory with one FLAC file) or "multidisc" (no FLAC files; the discs are subdirectories)
+#           or "files" (FLAC files taken one by one, without looking at albums; see planFiles)
+#   "input", "output": the directory and where its outputs go
+#   "tracks": (source, output) pairs of the FLAC files to convert
+#   "files": other files that are copied over as they are
+# Entries come out in the order they are converted: a directory's own files first, then its subdirectories.
+
+from pathlib import Path
+import os
+
+from Probe import tag
+
+# Lists a directory once. Returns (FLAC files, other files, subdirectories), each sorted by name.
+def listDirectory(path: Path):
+    flacs, others, subdirs = [], [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # DirEntry answers is_dir() and is_file() from the listing itself on most systems, without a stat per file.
+            if entry.is_dir():
+                subdirs.append(Path(entry.path))
+            elif entry.is_file():
+                (flacs if entry.name.endswith(".flac") else others).append(Path(entry.path))
+    return sorted(flacs), sorted(others), sorted(subdirs)
+
+# Yields every FLAC file under root, depth first. Files come out as soon as their directory has been listed.
+def iterFlacs(root: Path):
+    flacs, _, subdirs = listDirectory(root)
+    yield from flacs
+    for subdir in subdirs:
+        yield from iterFlacs(subdir)
+
+# Yields every file under root whose name ends with one of suffixes (in any case), depth first. Files come out as soon as their directory has been listed.
+def iterFiles(root: Path, suffixes):
+    flacs, others, subdirs = listDirectory(root)
+    for file in sorted(flacs + others):
+        if file.name.lower().endswith(suffixes):
+            yield file
+    for subdir in subdirs:
+        yield from iterFiles(subdir, suffixes)
+
+def DirIsAnAlbum(flac_files, probe_cache):
+    # Returns 1 if the directory is an album,
+    # 0 if it is not (an artist directory with singles and albums)
+    # Negative values are exceptional cases:
+    # -1 if contains only one FLAC file (an artist directory with only one single so far)
+    # -2 if it contains no FLAC files (i.e., a base directory for a multidisc album).
+    # A directory is an album if it has multiple FLAC files, and all FLAC files share the same album name (same album tag).
+    if len(flac_files) == 1:
+        return -1
+    elif len(flac_files) == 0:
+        return -2
+    else:
+        # Get the album name of every FLAC file from the probe cache.
+        album_names = {tag(probe_cache.probe(file), "ALBUM").strip() for file in flac_files}
+        # Check if all FLAC files have the same album name.
+        return 1 if len(album_names) == 1 else 0
+
+# Yields the plan entries for the tree under input_root, to be mirrored under output_root.
+# Albums and single-track directories are leaves: their subdirectories (scans, extras) are not descended into.
+def planLibrary(input_root: Path, output_root: Path, probe_cache):
+    flacs, others, subdirs = listDirectory(input_root)
+    tracks = [(flac, output_root / flac.name) for flac in flacs]
+    match DirIsAnAlbum(flacs, probe_cache):
+        case 1:
+            yield {"kind": "album", "input": input_root, "output": output_root, "tracks": tracks, "files": others}
+            return
+        case -1:
+            yield {"kind": "single", "input": input_root, "output": output_root, "tracks": tracks, "files": others}
+            return
+        case 0:
+            # Only the singles are converted; other files next to them are left behind.
+            yield {"kind": "singles", "input": input_root, "output": output_root, "tracks": tracks, "files": []}
+        case -2:
+            yield {"kind": "multidisc", "input": input_root, "output": output_root, "tracks": [], "files": others}
+    for subdir in subdirs:
+        yield from planLibrary(subdir, output_root / subdir.name, probe_cache)
+
+# Yields a "files" entry for every directory under input_root that has FLAC files, to be mirrored under output_root. Nothing is classified, so nothing is probed, and other files are left behind.
+def planFiles(input_root: Path, output_root: Path):
+    flacs, _, subdirs = listDirectory(input_root)
+    if flacs:
+        yield {"kind": "files", "input": input_root, "output": output_root, "tracks": [(flac, output_root / flac.name) for flac in flacs], "files": []}
+    for subdir in subdirs:
+        yield from planFiles(subdir, output_root / subdir.name)
+
+# Returns a plan entry with its paths as strings, for dumping as JSON.
+def entryToJSON(entry):
+    return {
+        "kind": entry["kind"],
+        "input": str(entry["input"]),
+        "output": str(entry["output"]),
+        "tracks": [{"source": str(source), "output": str(output)} for source, output in entry["tracks"]],
+        "files": [str(file) for file in entry["files"]],
+    }
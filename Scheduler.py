@@ -0,0 +1,234 @@
+# Staged scheduler for converting tracks.
+# Every track goes through a chain of stages (probe, resample, encode, tag), and every stage has a bounded queue and a pool of workers of its own.
+# Stages with different resource profiles (process spawning, CPU, the encoder's device) then overlap across tracks, instead of taking turns inside each track.
+# Queues are bounded, so a stage that gets ahead blocks instead of piling up work (and temp files) in front of a slower one.
+# A controller looks at the queues a few times a second and tunes the number of workers of every stage but the bottleneck (the encoder), whose worker count is fixed:
+#   the bottleneck is idle while work waits upstream: the upstream stage with the deepest queue gets a worker
+#   a stage's queue is full while its output queue is not: it gets a worker, since it is holding up the stage before it
+#   a stage's output queue is full: it gives a worker back, since its work only waits there
+# A stage's output queue is the queue of the stage its jobs mostly go on to, which need not be the next one in the chain (tracks that need no resampling skip that stage).
+# With a memory budget, every job reserves what its stage says it needs before it starts, and waits while the budget is spent.
+
+from queue import Queue, Empty, Full
+from threading import Thread, Condition
+from time import perf_counter
+
+# Seconds between looks at the queues.
+CONTROL_INTERVAL = 0.25
+# Put in every queue by close(), to wake the workers waiting on it.
+STOP = object()
+
+# The error done(job, error) gets for a job that was dropped because the scheduler was closed before the job was done.
+class Cancelled(Exception):
+    pass
+
+# One stage. function(job) does the stage's work on a job and returns the name of the next stage, or None when the job is done.
+# The stage starts with workers workers, and is tuned between min_workers and max_workers. cost(job), if given, is the memory in bytes the stage needs for a job.
+class Stage:
+    def __init__(self, name, function, workers=1, min_workers=1, max_workers=None, queue_size=None, cost=None):
+        self.name = name
+        self.function = function
+        self.max_workers = max(workers, max_workers or workers)
+        self.min_workers = min(min_workers, workers)
+        self.target = workers
+        self.cost = cost
+        self.queue = Queue(maxsize=queue_size or 2 * self.max_workers)
+        # Workers allowed to take jobs (at most target), and workers running a job.
+        self.claimed = 0
+        self.busy = 0
+        # How many jobs went on to each stage from this one.
+        self.feeds = {}
+        # For the summary.
+        self.peak_target = workers
+        self.peak_depth = 0
+
+# Runs jobs through stages, the first stage first. bottleneck names the stage that must never run dry. memory_budget is in bytes, or None for no limit. Safe to submit to from several threads.
+class StagedScheduler:
+    def __init__(self, stages, bottleneck, memory_budget=None):
+        self.order = list(stages)
+        self.stages = {stage.name: stage for stage in stages}
+        self.bottleneck = self.stages[bottleneck]
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.peak_memory = 0
+        # Guards worker counts, memory, in_flight, errors and closed.
+        self.condition = Condition()
+        self.in_flight = 0
+        self.errors = []
+        self.closed = False
+        # Seconds the bottleneck sat idle while jobs were in flight.
+        self.starved = 0.0
+        self.started = perf_counter()
+        self.threads = [Thread(target=self.work, args=(stage,), daemon=True) for stage in self.order for _ in range(stage.max_workers)]
+        self.threads.append(Thread(target=self.control, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    # Queues a job at the first stage, blocking while that stage's queue is full. done(job, error) is called once the job has left the last stage (error None), a stage has raised (error is the exception), or the scheduler was closed first (error is Cancelled).
+    def submit(self, job, done):
+        with self.condition:
+            self.in_flight += 1
+        self.put(self.order[0], job, done)
+
+    # Queues a job at stage, blocking while its queue is full. The job is dropped if the scheduler is closed meanwhile, since the workers that would make room are gone.
+    def put(self, stage: Stage, job, done):
+        with self.condition:
+            # Checked under the lock, so nothing is queued once close() has started to drop what is queued.
+            while not self.closed:
+                try:
+                    stage.queue.put_nowait((job, done))
+                    return
+                except Full:
+                    self.condition.wait(CONTROL_INTERVAL)
+        self.finish(job, done, Cancelled(f"Dropped before the {stage.name} stage: the scheduler was closed."))
+
+    # Waits until every submitted job is done, then re-raises the first failure, if any.
+    def wait(self):
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait()
+            if self.errors:
+                raise self.errors[0]
+
+    # Stops every worker, once it has finished the job it is running. Jobs still queued are dropped (see submit), so wait() first.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        # A queue with room may have workers waiting on it; a full one has none.
+        for stage in self.order:
+            for _ in range(stage.max_workers):
+                try:
+                    stage.queue.put_nowait(STOP)
+                except Full:
+                    break
+        for thread in self.threads:
+            thread.join()
+        for stage in self.order:
+            while True:
+                try:
+                    item = stage.queue.get_nowait()
+                except Empty:
+                    break
+                if item is not STOP:
+                    self.finish(*item, Cancelled(f"Dropped from the {stage.name} queue: the scheduler was closed."))
+
+    def work(self, stage: Stage):
+        while True:
+            # Only target workers of a stage take jobs; the rest are parked until the controller wants them.
+            with self.condition:
+                while not self.closed and stage.claimed >= stage.target:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                stage.claimed += 1
+            try:
+                item = None
+                while item is None:
+                    try:
+                        item = stage.queue.get(timeout=CONTROL_INTERVAL)
+                    except Empty:
+                        with self.condition:
+                            if self.closed or stage.claimed > stage.target:
+                                break
+                if item is STOP:
+                    return
+                if item is not None:
+                    self.runJob(stage, *item)
+            finally:
+                with self.condition:
+                    stage.claimed -= 1
+                    self.condition.notify_all()
+
+    def runJob(self, stage: Stage, job, done):
+        cost = stage.cost(job) if stage.cost is not None and self.memory_budget is not None else 0
+        with self.condition:
+            # A job that needs more than the whole budget runs alone rather than never.
+            cost = min(cost, self.memory_budget) if cost else 0
+            while cost and not self.closed and self.memory_used + cost > self.memory_budget:
+                self.condition.wait()
+            closed = self.closed
+            # The job left a queue, which may have room for a job waiting in put().
+            self.condition.notify_all()
+            if not closed:
+                stage.busy += 1
+                self.memory_used += cost
+                self.peak_memory = max(self.peak_memory, self.memory_used)
+        if closed:
+            self.finish(job, done, Cancelled(f"Dropped before the {stage.name} stage: the scheduler was closed."))
+            return
+        error = None
+        next_stage = None
+        try:
+            next_stage = stage.function(job)
+        except BaseException as exception:
+            error = exception
+        finally:
+            with self.condition:
+                stage.busy -= 1
+                self.memory_used -= cost
+                if next_stage is not None:
+                    stage.feeds[next_stage] = stage.feeds.get(next_stage, 0) + 1
+                self.condition.notify_all()
+        if next_stage is not None:
+            self.put(self.stages[next_stage], job, done)
+        else:
+            self.finish(job, done, error)
+
+    # Hands a job that is done, failed or dropped to its done(), and counts it out.
+    def finish(self, job, done, error):
+        try:
+            done(job, error)
+        except BaseException as exception:
+            error = error or exception
+        with self.condition:
+            if error is not None:
+                self.errors.append(error)
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    # Tunes worker counts from the queue depths, as described at the top.
+    def control(self):
+        last = perf_counter()
+        while True:
+            with self.condition:
+                self.condition.wait(CONTROL_INTERVAL)
+                if self.closed:
+                    return
+                now = perf_counter()
+                for stage in self.order:
+                    stage.peak_depth = max(stage.peak_depth, stage.queue.qsize())
+                bottleneck = self.bottleneck
+                upstream = self.order[:self.order.index(bottleneck)]
+                starving = bottleneck.queue.empty() and bottleneck.busy < bottleneck.target and self.in_flight > bottleneck.busy
+                if starving:
+                    self.starved += now - last
+                    waiting = [stage for stage in upstream if stage.queue.qsize() and stage.target < stage.max_workers]
+                    if waiting:
+                        self.grow(max(waiting, key=lambda stage: stage.queue.qsize()))
+                for stage in self.order:
+                    if stage is bottleneck:
+                        continue
+                    output = self.stages[max(stage.feeds, key=stage.feeds.get)].queue if stage.feeds else None
+                    blocked = output is not None and output.full()
+                    if stage.queue.full() and not blocked:
+                        self.grow(stage)
+                    elif blocked and not starving and stage.target > stage.min_workers:
+                        stage.target -= 1
+                last = now
+                self.condition.notify_all()
+
+    def grow(self, stage: Stage):
+        if stage.target < stage.max_workers:
+            stage.target += 1
+            stage.peak_target = max(stage.peak_target, stage.target)
+
+    # Returns the end-of-run summary as lines of text: per stage the workers it ended with and peaked at, and its deepest queue; how long the bottleneck was starved; and the peak memory reserved.
+    def summary(self):
+        lines = [f"{'scheduler stage':<24}{'workers':>9}{'peak':>6}{'queue':>7}"]
+        for stage in self.order:
+            lines.append(f"{stage.name:<24}{stage.target:>9}{stage.peak_target:>6}{stage.peak_depth:>7}")
+        line = f"{self.bottleneck.name} starved for {self.starved:.1f} s of {perf_counter() - self.started:.1f} s"
+        if self.memory_budget is not None:
+            line += f", peak memory reserved {self.peak_memory >> 20} of {self.memory_budget >> 20} MB"
+        return lines + [line]
@@ -0,0 +1,87 @@
+# Per-stage timing instrumentation.
+# Every timed stage (a subprocess, a pipeline stage, a probe, a tag write) becomes one record: wall time, bytes in and out, and realtime factor where the audio length is known.
+# Records are appended to a JSON lines file as they happen, so a run can be followed (or analysed after a crash) with any JSON tool, and are summarised per stage at the end of the run.
+
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, time
+import json
+import re
+
+# Returns a short stage name for a command: the executable's name without directory or ".exe". Takes a shell command string or an argument list.
+def stageName(command):
+    if isinstance(command, str):
+        command = re.findall(r'"[^"]*"|\S+', command)[:1]
+    if not command:
+        return "command"
+    name = re.split(r"[\\/]", str(command[0]).strip('"'))[-1]
+    return name[:-4] if name.lower().endswith(".exe") else name
+
+# Returns the p-th percentile (0-100) of a non-empty list of numbers, by the nearest-rank method.
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+# Collects stage timings. Safe to share between worker threads.
+class StageTimer:
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.lock = Lock()
+        self.records = []
+        self.started = perf_counter()
+        self.log = open(log_file, "a", encoding="utf-8") if log_file is not None else None
+
+    # Records one run of a stage that took seconds. Known fields: track, bytes_in, bytes_out, audio_seconds (length of the audio it handled), ok.
+    def record(self, stage, seconds, **fields):
+        record = {"time": round(time(), 3), "stage": stage, "seconds": round(seconds, 6)}
+        record.update((name, value) for name, value in fields.items() if value is not None)
+        if record.get("audio_seconds") and seconds > 0:
+            record["realtime"] = round(record["audio_seconds"] / seconds, 3)
+        with self.lock:
+            self.records.append(record)
+            if self.log is not None:
+                self.log.write(json.dumps(record) + "\n")
+                self.log.flush()
+
+    # Times the body of a with block as one run of stage. Yields the record's fields, so the body can fill in what it only learns on the way (such as bytes_out).
+    @contextmanager
+    def time(self, stage, **fields):
+        start = perf_counter()
+        ok = False
+        try:
+            yield fields
+            ok = True
+        finally:
+            if not ok:
+                fields["ok"] = False
+            self.record(stage, perf_counter() - start, **fields)
+
+    # Returns the end-of-run summary as lines of text: per stage the number of runs, total time, p50/p95 wall time, source MB/s and median realtime factor; overall tracks/hour.
+    # tracks_stage is the stage that is timed once per track (or per whatever unit the script works on).
+    def summary(self, tracks_stage="track", unit="tracks"):
+        with self.lock:
+            records = list(self.records)
+        elapsed = perf_counter() - self.started
+        stages = {}
+        for record in records:
+            stages.setdefault(record["stage"], []).append(record)
+        lines = [f"{'stage':<24}{'runs':>7}{'total s':>10}{'p50 s':>9}{'p95 s':>9}{'MB/s':>9}{'realtime':>10}"]
+        for stage, runs in sorted(stages.items(), key=lambda item: -sum(record["seconds"] for record in item[1])):
+            seconds = [record["seconds"] for record in runs]
+            total = sum(seconds)
+            bytes_in = sum(record.get("bytes_in", 0) for record in runs)
+            throughput = f"{bytes_in / total / 1e6:.1f}" if bytes_in and total else "-"
+            realtimes = [record["realtime"] for record in runs if "realtime" in record]
+            realtime = f"{percentile(realtimes, 50):.1f}x" if realtimes else "-"
+            lines.append(f"{stage:<24}{len(runs):>7}{total:>10.1f}{percentile(seconds, 50):>9.3f}{percentile(seconds, 95):>9.3f}{throughput:>9}{realtime:>10}")
+        tracks = [record for record in records if record["stage"] == tracks_stage and record.get("ok", True)]
+        source_bytes = sum(record.get("bytes_in", 0) for record in tracks)
+        lines.append(f"{len(tracks)} {unit} in {elapsed:.1f} s: {len(tracks) * 3600 / elapsed if elapsed else 0:.0f} {unit}/hour, {source_bytes / elapsed / 1e6 if elapsed else 0:.1f} MB/s")
+        return lines
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
@@ -1,24 +1,27 @@
-from pathlib import Path, PurePath
+from pathlib import Path
+from concurrent.futures import as_completed
 from pyprog import ProgressBar
-from os import system as cmd
-from os import chdir as cd
+from Timing import StageTimer
 from os import makedirs
-from os.path import exists, dirname
-from time import sleep
+from Scanner import iterFiles
+from Mirror import Mirror
 
 in_dir = Path(input("Input Directory: "))
 out_dir = Path(input("Output Directory: "))
-in_covers = tuple(in_dir.glob("**/*.jpg"))+tuple(in_dir.glob("**/*.png"))
-out_covers = tuple([Path(str(out_dir)+"\\"+str(cover.relative_to(in_dir))) for cover in in_covers])
-assert len(in_covers) == len(out_covers)
-covers = tuple(zip(in_covers, out_covers))
-progress = ProgressBar("Transferring... ","",len(covers))
-for count, cover in enumerate(covers):
+# Every cover is timed and summarised at the end; the timings also go to a JSON lines log if one is given.
+timing_log = input("Timing Log (leave empty for none): ")
+makedirs(out_dir, exist_ok=True)
+timer = StageTimer(Path(timing_log) if timing_log else None)
+# Covers are mirrored on a pool of threads, as reflinks or hard links where the filesystem allows. Covers whose copy is already up to date are skipped.
+mirror = Mirror(jobs=8, timer=timer, stage="cover")
+# The tree is listed once, and covers start transferring as soon as their directory has been listed.
+covers = [mirror.submit(cover, out_dir / cover.relative_to(in_dir)) for cover in iterFiles(in_dir, (".jpg", ".png"))]
+progress = ProgressBar("Transferring... ","",max(len(covers), 1))
+for count, cover in enumerate(as_completed(covers)):
+    cover.result()
     progress.set_stat(count+1)
     progress.update()
-    print("\noriginal: %s" % str(cover[0]))
-    print("destination: %s\n" % str(cover[1]))
-    if not exists(dirname(str(cover[1]))):
-        makedirs(dirname(str(cover[1])))
-    cmd("copy \"%s\" \"%s\"" % (str(cover[0]), str(cover[1])))
-progress.end()
\ No newline at end of file
+mirror.close()
+progress.end()
+print("\n".join(timer.summary("cover", "covers") + mirror.summary("covers")))
+timer.close()